@@ -0,0 +1,95 @@
+"""
+Benchmark of the memory and hashing cost of the entity classes
+
+    python -m streamlod.benchmarks.entities [count]
+
+Builds count objects, each with an author, and count activities, with the slotted entities
+and with the previous implementation, based on instance dictionaries and hashes computed on every call.
+Reports the memory they take and the time to put them into sets twice.
+"""
+import sys
+import tracemalloc
+from time import perf_counter
+from typing import Any, Callable, List, Optional, Set
+
+from streamlod.entities import Person, Painting, Processing
+
+class PlainPerson:
+    """
+    The previous entity classes, for reference.
+    """
+    def __init__(self, identifier: str, name: str):
+        self.identifier = identifier
+        self.name = name
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, self.__class__) and (self.identifier, self.name) == (other.identifier, other.name)
+
+    def __hash__(self):
+        return hash((self.identifier, self.name))
+
+class PlainObject:
+    def __init__(self, identifier: str, title: str, owner: str, place: str, date: Optional[str] = None, hasAuthor: Optional[List[PlainPerson]] = None):
+        self.identifier = identifier
+        self.title = title
+        self.owner = owner
+        self.place = place
+        self.date = date
+        self.hasAuthor = [] if hasAuthor is None else hasAuthor
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, self.__class__) and self.identifier == other.identifier and tuple(self.hasAuthor) == tuple(other.hasAuthor)
+
+    def __hash__(self):
+        return hash((self.identifier, self.title, self.owner, self.place, self.date, tuple(self.hasAuthor)))
+
+class PlainActivity:
+    def __init__(self, refersTo: PlainObject, institute: str, person: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None, tool: Optional[Set[str]] = None):
+        self.institute = institute
+        self.person = person
+        self.tool = set() if tool is None else tool
+        self.start = start
+        self.end = end
+        self.object = refersTo
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, self.__class__) and self.object == other.object and frozenset(self.tool) == frozenset(other.tool)
+
+    def __hash__(self):
+        return hash((self.institute, self.person, frozenset(self.tool), self.start, self.end, self.object))
+
+def build(count: int, person: Callable[..., Any], cho: Callable[..., Any], activity: Callable[..., Any]) -> tuple[list, list]:
+    """
+    Objects and activities with values repeated as they are in query results: equal, but separate strings.
+    """
+    people = [person(f'VIAF:{i}', f'Name {i}') for i in range(max(1, count // 10))]
+    objects = [
+        cho(str(i), f'Title {i}', f'Owner {i % 100}', f'Place {i % 50}', f'{1500 + i % 400}', [people[i % len(people)]])
+        for i in range(count)
+    ]
+    activities = [
+        activity(obj, f'Institute {i % 20}', f'Person {i % 200}', f'2023-0{1 + i % 9}-01', f'2023-1{i % 3}-01', {f'Tool {i % 30}'})
+        for i, obj in enumerate(objects)
+    ]
+    return objects, activities
+
+def main(count: int = 1000000) -> None:
+    for name, classes in (('plain', (PlainPerson, PlainObject, PlainActivity)), ('slots', (Person, Painting, Processing))):
+        tracemalloc.start()
+        start = perf_counter()
+        objects, activities = build(count, *classes)
+        elapsed = perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+        print(f'{name:>6}: built in {elapsed:.2f}s, {memory:.0f} MiB for {count} objects and activities')
+
+        for run in ('first', 'second'):
+            start = perf_counter()
+            set(objects)
+            set(activities)
+            elapsed = perf_counter() - start
+            print(f'{"":>6}  {run} hashing: {elapsed:.2f}s, {2 * count / elapsed / 1e6:.2f}M entities/s')
+        del objects, activities
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
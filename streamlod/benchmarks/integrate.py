@@ -0,0 +1,78 @@
+"""
+Benchmark of the cross-source integration step of the mashup
+
+    python -m streamlod.benchmarks.integrate [rows]
+
+Compares BasicMashup._integrate and _validate with the previous implementation,
+based on a full sort and a grouped backward fill, on synthetic results of three sources.
+"""
+import sys
+from time import perf_counter
+from typing import List
+import numpy as np
+import pandas as pd
+
+from streamlod.mashups import BasicMashup
+from streamlod.utils import sorter
+
+CHO_COLUMNS = ['class', 'identifier', 'title', 'owner', 'place', 'date', 'p_identifier', 'p_name']
+
+def bfill_integrate(dfs: List[pd.DataFrame], entity_name: str) -> pd.DataFrame:
+    """
+    The previous integration step, for reference.
+    """
+    df = pd.concat(dfs)
+    match entity_name:
+        case 'Person':
+            df = df.sort_values(by='name', ignore_index=True)
+            df.update(df.groupby('identifier').bfill())
+        case 'CHO':
+            df = df.sort_values(by=['identifier', 'p_name'], key=sorter, ignore_index=True)
+            df.update(df.groupby('identifier').bfill())
+    return df
+
+def sources(rows: int, count: int = 3, seed: int = 0) -> List[pd.DataFrame]:
+    """
+    Object results of count sources with overlapping identifiers, up to two authors
+    per object and some attributes missing in each source.
+    """
+    rng = np.random.default_rng(seed)
+    objects = rows // (count * 2)
+    dfs = []
+    for _ in range(count):
+        ids = rng.choice(objects * 2, size=objects, replace=False)
+        authors = rng.integers(0, 3, size=objects)
+        ids = np.repeat(ids, np.maximum(authors, 1))
+        df = pd.DataFrame({
+            'class': 'Painting',
+            'identifier': ids.astype(str),
+            'title': 'Title ' + pd.Series(ids).astype(str),
+            'owner': 'Owner',
+            'place': 'Place',
+            'date': None,
+            'p_identifier': 'VIAF:' + pd.Series(rng.integers(0, objects, size=len(ids))).astype(str),
+        }, columns=CHO_COLUMNS[:-1]).astype(object)
+        df['p_name'] = 'Name ' + df['p_identifier'].str[5:]
+        no_author = np.repeat(authors == 0, np.maximum(authors, 1))
+        df.loc[no_author, ['p_identifier', 'p_name']] = None
+        for column in ('title', 'owner', 'place'):
+            df.loc[rng.random(len(df)) < 0.1, column] = None
+        dfs.append(df)
+    return dfs
+
+def timed(function, *args) -> tuple[float, pd.DataFrame]:
+    start = perf_counter()
+    result = function(*args)
+    return perf_counter() - start, result
+
+def main(rows: int = 200000) -> None:
+    mashup = BasicMashup()
+    dfs = sources(rows)
+    print(f'{sum(len(df) for df in dfs)} merged object rows')
+
+    for name, integrate in (('bfill', bfill_integrate), ('first', mashup._integrate)):
+        elapsed, df = timed(lambda: mashup._validate(integrate([df.copy() for df in dfs], 'CHO'), 'CHO'))
+        print(f'{name:>6}: {elapsed:.3f}s, {len(df)} rows, {df.identifier.nunique()} objects')
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
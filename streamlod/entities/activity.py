@@ -1,9 +1,16 @@
-from typing import Union, Optional, Set
+from typing import Union, Optional, Iterable, Set
 
 from streamlod.entities.identifiable_entity import CulturalHeritageObject
-from streamlod.utils import rank
+from streamlod.utils import rank, interned
 
 class Activity:
+    """
+    Activities are not changed once built: their hash is computed on first use and cached in _hash,
+    and instances keep their attributes in slots instead of a dictionary.
+    Tools are stored as a frozenset, and returned by getTools as a new set.
+    """
+    __slots__ = ('institute', 'person', 'tool', 'start', 'end', 'object', '_hash')
+
     def __init__(
         self,
         refersTo: CulturalHeritageObject,
@@ -11,24 +18,25 @@ class Activity:
         person: Optional[str] = None,
         start: Optional[str] = None,
         end: Optional[str] = None,
-        tool: Optional[Set[str]] = None
+        tool: Optional[Iterable[str]] = None
     ):
-        self.institute = institute
-        self.person = person
-        # Setting the default value directly as empty set would share the same set among all the instances of the class
-        self.tool = set() if tool is None else tool
-        self.start = start
-        self.end = end
+        # Values repeated across activities are shared
+        self.institute = interned(institute)
+        self.person = interned(person)
+        self.tool = frozenset() if tool is None else frozenset(interned(name) for name in tool)
+        self.start = interned(start)
+        self.end = interned(end)
         # Since the relation is homonymous with the method accessing it, it is declared as internal
         # and renamed via the property decorator
         self.object = refersTo
+        self._hash: Optional[int] = None
 
     def __repr__(self) -> str:
         return (
             f'{self.__class__.__name__}('
             f'institute={self.institute!r}, '
             f'person={self.person!r}, '
-            f'tool={self.tool!r}, '
+            f'tool={set(self.tool)!r}, '
             f'start={self.start!r}, '
             f'end={self.end!r}, '
             f'refersTo={self.object!r})'
@@ -38,16 +46,18 @@ class Activity:
         yield int(self.object.identifier) if self.object.identifier.isdigit() else self.object.identifier
         yield "institute", self.institute
         yield "person", self.person
-        yield "tool", self.tool
+        yield "tool", set(self.tool)
         yield "start", self.start
         yield "end", self.end
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return False
+        if self._hash is not None and other._hash is not None and self._hash != other._hash:
+            return False
         return (self.institute == other.institute and
                 self.person == other.person and
-                frozenset(self.tool) == frozenset(other.tool) and
+                self.tool == other.tool and
                 self.start == other.start and
                 self.end == other.end and
                 self.object == other.object)
@@ -59,13 +69,15 @@ class Activity:
             return rank[self.__class__.__name__] < rank[other.__class__.__name__]
 
     def __hash__(self):
-        return hash((
-            self.institute,
-            self.person,
-            frozenset(self.tool),
-            self.start,
-            self.end,
-            self.object))
+        if self._hash is None:
+            self._hash = hash((
+                self.institute,
+                self.person,
+                self.tool,
+                self.start,
+                self.end,
+                self.object))
+        return self._hash
 
     def getResponsibleInstitute(self) -> str:
         return self.institute
@@ -74,7 +86,7 @@ class Activity:
         return self.person
     
     def getTools(self) -> Set[str]:
-        return self.tool
+        return set(self.tool)
     
     def getStartDate(self) -> Union[str, None]:
         return self.start
@@ -87,6 +99,8 @@ class Activity:
 
 
 class Acquisition(Activity):
+    __slots__ = ('technique',)
+
     def __init__(
         self,
         refersTo: CulturalHeritageObject,
@@ -95,10 +109,10 @@ class Acquisition(Activity):
         person: Optional[str] = None,
         start: Optional[str] = None,
         end: Optional[str] = None,
-        tool: Optional[set[str]] = None,
+        tool: Optional[Iterable[str]] = None,
     ):
         super().__init__(refersTo, institute, person, start, end, tool)
-        self.technique = technique
+        self.technique = interned(technique)
 
     def __repr__(self) -> str:
         return (
@@ -106,7 +120,7 @@ class Acquisition(Activity):
             f'institute={self.institute!r}, '
             f'person={self.person!r}, '
             f'technique={self.technique!r}, '
-            f'tool={self.tool!r}, '
+            f'tool={set(self.tool)!r}, '
             f'start={self.start!r}, '
             f'end={self.end!r}, '
             f'refersTo={self.object!r})'
@@ -117,7 +131,7 @@ class Acquisition(Activity):
         yield "institute", self.institute
         yield "person", self.person
         yield "technique", self.technique
-        yield "tool", self.tool
+        yield "tool", set(self.tool)
         yield "start", self.start
         yield "end", self.end
 
@@ -125,30 +139,32 @@ class Acquisition(Activity):
         return super().__eq__(other) and self.technique == other.technique
 
     def __hash__(self):
-        return hash((
-            self.institute,
-            self.person,
-            self.technique,
-            frozenset(self.tool),
-            self.start,
-            self.end,
-            self.object))
+        if self._hash is None:
+            self._hash = hash((
+                self.institute,
+                self.person,
+                self.technique,
+                self.tool,
+                self.start,
+                self.end,
+                self.object))
+        return self._hash
 
     def getTechnique(self) -> str:
         return self.technique
 
 
 class Processing(Activity):
-    pass
+    __slots__ = ()
 
 
 class Modelling(Activity):
-    pass
+    __slots__ = ()
 
 
 class Optimising(Activity):
-    pass
+    __slots__ = ()
 
 
 class Exporting(Activity):
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
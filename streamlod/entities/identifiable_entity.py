@@ -1,14 +1,24 @@
-from typing import Union, Optional, List
+from typing import Union, Optional, Iterable, List
 
-from streamlod.utils import key
+from streamlod.utils import key, interned
 
 class IdentifiableEntity:
+    """
+    Entities are not changed once built: their hash is computed on first use and cached in _hash,
+    and instances keep their attributes in slots instead of a dictionary.
+    Collections are stored as tuples and frozensets, and returned by the getters as new lists and sets.
+    """
+    __slots__ = ('identifier', '_hash')
+
     def __init__(self, identifier: str):
         self.identifier = identifier
+        self._hash: Optional[int] = None
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return False
+        if self._hash is not None and other._hash is not None and self._hash != other._hash:
+            return False
         return self.identifier == other.identifier
 
     def getId(self) -> str:
@@ -16,9 +26,11 @@ class IdentifiableEntity:
 
 
 class Person(IdentifiableEntity):
+    __slots__ = ('name',)
+
     def __init__(self, identifier: str, name: str):
         super().__init__(identifier)
-        self.name = name
+        self.name = interned(name)
 
     def __repr__(self) -> str:
         return f'Person(id={self.identifier!r}, name={self.name!r})'
@@ -35,13 +47,17 @@ class Person(IdentifiableEntity):
         return self.name < other.name
 
     def __hash__(self):
-        return hash((self.identifier, self.name))
+        if self._hash is None:
+            self._hash = hash((self.identifier, self.name))
+        return self._hash
 
     def getName(self) -> str:
         return self.name
 
 
 class CulturalHeritageObject(IdentifiableEntity):
+    __slots__ = ('title', 'owner', 'place', 'date', 'hasAuthor')
+
     def __init__(
         self,
         identifier: str,
@@ -49,15 +65,15 @@ class CulturalHeritageObject(IdentifiableEntity):
         owner: str,
         place: str,
         date: Optional[str] = None,
-        hasAuthor: Optional[List[Person]] = None
+        hasAuthor: Optional[Iterable[Person]] = None
     ):
         super().__init__(identifier)
         self.title = title
-        self.owner = owner
-        self.place = place
-        self.date = date
-        # Setting the default value directly as empty list would share the same list among all the instances of the class
-        self.hasAuthor = [] if hasAuthor is None else hasAuthor
+        # Values repeated across objects are shared
+        self.owner = interned(owner)
+        self.place = interned(place)
+        self.date = interned(date)
+        self.hasAuthor = () if hasAuthor is None else tuple(hasAuthor)
 
     def __repr__(self) -> str:
         return (
@@ -67,7 +83,7 @@ class CulturalHeritageObject(IdentifiableEntity):
             f'owner={self.owner!r}, '
             f'place={self.place!r}, '
             f'date={self.date!r}, '
-            f'hasAuthor={self.hasAuthor!r})'
+            f'hasAuthor={list(self.hasAuthor)!r})'
         )
 
     def __rich_repr__(self):
@@ -76,7 +92,7 @@ class CulturalHeritageObject(IdentifiableEntity):
         yield "owner", self.owner
         yield "place", self.place
         yield "date", self.date
-        yield "hasAuthor", self.hasAuthor
+        yield "hasAuthor", list(self.hasAuthor)
 
     def __eq__(self, other) -> bool:
         return (super().__eq__(other) and
@@ -84,20 +100,22 @@ class CulturalHeritageObject(IdentifiableEntity):
                 self.owner == other.owner and
                 self.place == other.place and
                 self.date == other.date and
-                tuple(self.hasAuthor) == tuple(other.hasAuthor))
+                self.hasAuthor == other.hasAuthor)
 
     def __lt__(self, other) -> bool:
         # Numeric and alphabetic identifiers are placed respecitvely in a 0 or 1 tuple to allow for comparison
         return key(self.identifier) < key(other.identifier)
 
     def __hash__(self):
-        return hash((
-            self.identifier,
-            self.title,
-            self.owner,
-            self.place,
-            self.date,
-            tuple(self.hasAuthor)))
+        if self._hash is None:
+            self._hash = hash((
+                self.identifier,
+                self.title,
+                self.owner,
+                self.place,
+                self.date,
+                self.hasAuthor))
+        return self._hash
 
     def getTitle(self) -> str:
         return self.title
@@ -112,44 +130,44 @@ class CulturalHeritageObject(IdentifiableEntity):
         return self.place
 
     def getAuthors(self) -> List[Person]:
-        return self.hasAuthor
+        return list(self.hasAuthor)
 
 
 class NauticalChart(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class ManuscriptPlate(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class ManuscriptVolume(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class PrintedVolume(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class PrintedMaterial(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class Herbarium(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class Specimen(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class Painting(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class Model(CulturalHeritageObject):
-    pass
+    __slots__ = ()
 
 
 class Map(CulturalHeritageObject):
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
@@ -1,7 +1,7 @@
 from typing import NamedTuple, Union, Dict, List, TypeVar, TypeAlias, Callable, TypedDict, Optional, Iterable
 from rdflib.namespace import Namespace, DC, FOAF, RDF, RDFS
 import pandas as pd
-from streamlod.utils import key
+from streamlod.utils import id_rank, quote_all
 
 T = TypeVar('T')
 Some: TypeAlias = T | Iterable[T]
@@ -22,7 +22,7 @@ class EntityMap(TypedDict):
     entity: str
     attributes: Dict[str, Attribute]
     sort_by: str
-    key: Optional[Callable[[pd.Series], pd.Series]]
+    rank: Optional[Callable[[str], int]] # Integer rank of the sort_by attribute, precomputed at ingest
 
 AttributeMap = Dict[str, bool]
 
@@ -50,7 +50,7 @@ IDE: Dict[str, EntityMap] = {
             'place': Attribute(4, True, None, 'dc:coverage', str)
         },
         'sort_by': 'identifier',
-        'key': (lambda x: x.map(key)),
+        'rank': id_rank,
     },
     'Person': {
         'entity': 'edm:Agent',
@@ -59,7 +59,7 @@ IDE: Dict[str, EntityMap] = {
             'name': Attribute(1, True, None, 'foaf:name', str)
         },
         'sort_by': 'name',
-        'key': None,
+        'rank': None,
     }
 }
 
@@ -100,8 +100,8 @@ class MapMeta(type):
         # Custom prefixes clause
         cls.prefixes = '\n'.join(f'PREFIX {prefix}: <{ns}>'for prefix, ns in NS.items()) + '\n\n'
 
-        # Columns to be sorted and sorting key per entity DataFrame
-        cls.sort_by = {entity_name: (cls._sort_map(entity_name), mapping['key']) for entity_name, mapping in IDE.items()}
+        # Precomputed rank triple and order clause per entity
+        cls.order_by = {entity_name: cls._order_map(entity_name) for entity_name in IDE}
 
         # Columns to be stipped of the uri per entity DataFrame
         cls.uri_strip = {entity_name: cls._uri_map(entity_name) for entity_name in IDE}
@@ -153,6 +153,14 @@ class MapMeta(type):
                 result += [f'{entity_name2.lower()[:1]}_{name}' for name in cls._sort_map(entity_name2)]
         return result
 
+    def _order_map(cls, entity_name: str) -> tuple[Optional[str], str]:
+        order = [f'?{name}' for name in cls._sort_map(entity_name)]
+        if IDE[entity_name]['rank']: # The rank precedes the attribute it was computed on
+            order.insert(0, '?rank')
+            return 'OPTIONAL { ?s loc:rank ?rank . }', 'ORDER BY ' + ' '.join(order)
+        else:
+            return None, 'ORDER BY ' + ' '.join(order)
+
     def _uri_map(cls, entity_name: str) -> List[tuple[str, str]]:
         result = []
         attrs = IDE[entity_name]['attributes']
@@ -163,4 +171,70 @@ class MapMeta(type):
             elif isinstance((rel := attr.vtype), Relation):
                 entity_name2 = rel.name
                 result += [(f'{entity_name2.lower()[:1]}_{name}', uri) for name, uri in cls._uri_map(rel.name)]
-        return result
\ No newline at end of file
+        return result
+
+
+Related = Callable[[pd.DataFrame, str], List[str]]
+Step = Callable[[pd.DataFrame, Related], List[str]]
+
+class Emitter:
+    """
+    Turns the validated DataFrame of an identifiable entity, indexed by subject, into its list of triples.
+    The IDE mapping is compiled once into a plan of steps, one per attribute, with predicate and namespace
+    bound in advance: each step formats a whole column in a single comprehension.
+    Related entities are passed to the related callback, with the entity name, to be validated and converted.
+    """
+    def __init__(self, entity_name: str):
+        entity_map = IDE[entity_name]
+        entity, attrs = entity_map['entity'], entity_map['attributes']
+        self.steps: List[Step] = []
+
+        if 'class' in attrs:
+            class_ns = attrs['class'].vtype
+            self.steps.append(lambda df, related: [f'{class_ns}:{c} rdfs:subClassOf {entity} .' for c in df['class'].unique()])
+        else:
+            self.steps.append(lambda df, related: [f'{s} rdf:type {entity} .' for s in df.index.to_list()])
+
+        if (rank := entity_map['rank']): # Precomputed sorting key
+            sort_by = entity_map['sort_by']
+            self.steps.append(lambda df, related: [
+                f'{s} loc:rank {o} .' for s, o in zip(df.index.to_list(), map(rank, df[sort_by].to_list()))
+            ])
+
+        for name, attr in attrs.items():
+            self.steps.append(self._step(name, attr))
+
+    @staticmethod
+    def _column(name: str, sep: Optional[str]) -> Callable[[pd.DataFrame], pd.Series]:
+        if sep:
+            return lambda df: df[name].str.split(sep).explode().dropna()
+        return lambda df: df[name].dropna()
+
+    def _step(self, name: str, attr: Attribute) -> Step:
+        column, p = self._column(name, attr.sep), attr.predicate
+
+        if isinstance((ns := attr.vtype), str): # Namespace
+            def step(df: pd.DataFrame, related: Related) -> List[str]:
+                col = column(df)
+                return [f'{s} {p} {ns}:{o} .' for s, o in zip(col.index.to_list(), col.to_list())]
+
+        elif isinstance((rel := attr.vtype), Relation): # Related entity
+            entity_name2, pattern = rel.name, rel.pattern
+
+            def step(df: pd.DataFrame, related: Related) -> List[str]:
+                df2 = column(df).str.extract(pattern).dropna(subset=['identifier'])
+                links = [f'{s} {p} loc:{entity_name2}-{id2} .' for s, id2 in zip(df2.index.to_list(), quote_all(df2.identifier).to_list())]
+                return links + related(df2, entity_name2)
+
+        else: # Literal
+            def step(df: pd.DataFrame, related: Related) -> List[str]:
+                col = column(df)
+                return [f'{s} {p} "{o}" .' for s, o in zip(col.index.to_list(), col.to_list())]
+
+        return step
+
+    def __call__(self, df: pd.DataFrame, related: Related) -> List[str]:
+        triples = []
+        for step in self.steps:
+            triples += step(df, related)
+        return triples
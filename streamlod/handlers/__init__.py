@@ -1,2 +1,3 @@
 from streamlod.handlers.metadata import MetadataUploadHandler, MetadataQueryHandler
-from streamlod.handlers.process import ProcessDataUploadHandler, ProcessDataQueryHandler
\ No newline at end of file
+from streamlod.handlers.process import ProcessDataUploadHandler, ProcessDataQueryHandler
+from streamlod.handlers.replica import ReplicaGroup
\ No newline at end of file
@@ -1,3 +1,7 @@
+from typing import List, Iterable, Callable, Any
+
+from streamlod.utils import BloomFilter, SingleFlight
+
 class Handler:
     def __init__(self):
         self.dbPathOrUrl = ''
@@ -13,10 +17,71 @@ class Handler:
             return False
 
 class UploadHandler(Handler):
-    def pushDataToDb(self, path: str):
+    # Attempts of a failing batch, and first wait in seconds, doubled at every retry
+    retries = 5
+    backoff = 0.5
+
+    def __init__(self):
+        super().__init__()
+        # Identifiers stored in the database, to route mashup lookups
+        self.identifiers = BloomFilter()
+        # Called with the identifiers of every successful push
+        self.listeners: List[Callable[[List[str]], Any]] = []
+
+    def addListener(self, listener: Callable[[List[str]], Any]) -> bool:
+        self.listeners.append(listener)
+        return True
+
+    def _notify(self, identifiers: List[str]) -> None:
+        """
+        Calls the listeners with the pushed identifiers. A failing listener is reported and skipped:
+        the data is committed already, and the push keeps its result.
+        """
+        identifiers = list(dict.fromkeys(identifiers))
+        for listener in self.listeners:
+            try:
+                listener(identifiers)
+            except Exception as e:
+                print(e)
+
+    def _stored(self) -> Iterable[str]:
+        """
+        Identifiers of the entities already stored in the database.
+        """
+        return ()
+
+    def _index(self) -> None:
+        """
+        Rebuilds the filter of the identifiers from the database, with room for as many pushed ones.
+        """
+        identifiers = list(dict.fromkeys(self._stored()))
+        self.identifiers.rebuild(identifiers, capacity=max(100000, 2 * len(identifiers)))
+
+    def _track(self, identifiers: List[str]) -> None:
+        """
+        Adds the pushed identifiers to the filter, rebuilt from the database when it would exceed its capacity.
+        """
+        if self.identifiers.count + len(identifiers) > self.identifiers.capacity:
+            try:
+                return self._index()
+            except Exception as e: # Overfilled, the filter only gives more false positives
+                print(e)
+        self.identifiers.update(identifiers)
+
+    def setDbPathOrUrl(self, pathOrUrl: str) -> bool:
+        if pathOrUrl != self.dbPathOrUrl:
+            self.identifiers.clear()
+        return super().setDbPathOrUrl(pathOrUrl)
+
+    def pushDataToDb(self, path: str, *, resume: bool = False):
         pass
 
 class QueryHandler(Handler):
+    def __init__(self):
+        super().__init__()
+        # Identical concurrent queries share one execution
+        self.flight = SingleFlight()
+
     def getDbPathOrUrl(self) -> str:
         if not self.dbPathOrUrl:
             raise Exception('Query path not set.')
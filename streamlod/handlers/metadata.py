@@ -1,27 +1,40 @@
-from typing import Union, List, Set, Generator, Optional, Any, Iterable, TYPE_CHECKING
+from typing import Union, List, Dict, Set, Generator, Optional, Any, Iterable, TYPE_CHECKING
 import pandas as pd
 import numpy as np
 from rdflib import Graph
 from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
-from urllib.parse import quote_plus
 from urllib.error import URLError
 from SPARQLWrapper import SPARQLWrapper
 from io import StringIO
+from copy import copy
+import os
+
+try:
+    import pyarrow.parquet as pq
+except ImportError: # Parquet input is optional
+    pq = None
 
 from streamlod.handlers.base import UploadHandler, QueryHandler
 import streamlod.entities as entities
-from streamlod.entities.mappings import IDE, BASE, NS, Relation, MapMeta, Some
-from streamlod.utils import id_join
+from streamlod.entities.mappings import IDE, BASE, NS, MapMeta, Emitter, Some
+from streamlod.utils import id_join, file_format, quote_all, stable_hash, retry, coalesced, MAX_RANK, BloomFilter, MissCache
 
 if TYPE_CHECKING:
     from pandas._libs.missing import NAType
 
 
 class MetadataUploadHandler(UploadHandler):
+    batchSize = 10000 # Rows per update
+    # Triple emitters compiled once per entity of the mapping
+    emitters: Dict[str, Emitter] = {entityName: Emitter(entityName) for entityName in IDE}
+
     def __init__(self):
         super().__init__()
         self.store = SPARQLUpdateStore(autocommit=False, context_aware=False) # Database connection only on commit
         self.store.method = 'POST'
+        self._pushed: List[str] = [] # Identifiers of the push being prepared
+        self._minted: Set[str] = set() # Subjects of the related entities already converted in the push
+        self.deduplicated = 0 # Related entity occurrences skipped in the last push
 
     def setDbPathOrUrl(self, newDbPathOrUrl: str, *, reset: bool = False) -> bool:
         if not super().setDbPathOrUrl(newDbPathOrUrl):
@@ -35,11 +48,20 @@ class MetadataUploadHandler(UploadHandler):
         try:
             store.open((endpoint, endpoint))
             store.close()
+            self._index()
             return True
         except Exception as e:
             print(e)
             return False
 
+    def _stored(self) -> Iterable[str]:
+        """
+        Identifiers of the objects and people stored in the database, read through a query handler of the same endpoint.
+        """
+        handler = MetadataQueryHandler()
+        handler.setDbPathOrUrl(self.getDbPathOrUrl())
+        return np.concatenate([handler.getEntities(select_only='identifier'), handler.getEntities('Person', select_only='identifier')])
+
     def _check_class(self, string: str) -> Union[str, 'NAType']:
         string = ''.join(word.capitalize() for word in string.split())
         if hasattr(entities, string):
@@ -57,53 +79,81 @@ class MetadataUploadHandler(UploadHandler):
         else:
             df.dropna(subset='identifier', inplace=True)
 
-        df.index = df.identifier.map(lambda identifier: f'loc:{entityName}-{quote_plus(identifier)}')
+        df.index = f'loc:{entityName}-' + quote_all(df.identifier)
 
         return df
 
     def toRDF(self, df: pd.DataFrame, entityName: str = BASE) -> Generator[str, None, None]:
+        self._reset()
+        yield from self._triples(df, entityName)
+
+    def _reset(self) -> None:
+        self._pushed = []
+        self._minted = set()
+        self.deduplicated = 0
+
+    def _triples(self, df: pd.DataFrame, entityName: str = BASE) -> List[str]:
+        """
+        Validates the DataFrame of an entity and converts it at once with the emitter of the entity.
+        Related entities are converted once per push: occurrences of a subject already converted,
+        in the same DataFrame or in a previous batch of the push, only get the triple linking them.
+        """
         try:
-            entityMap = IDE[entityName]
-            entity, attrs = entityMap['entity'], entityMap['attributes']
+            emitter = self.emitters[entityName]
         except KeyError as e:
             raise ValueError(f"Entity '{entityName}' is not defined in the identifiable entities mapping.") from e
 
         df = self._validateIDE(df, entityName)
-
-        if 'class' in attrs:
-            class_ns = attrs['class'].vtype # Class namespace
-            for c in df['class'].unique():
-                yield f'{class_ns}:{c} rdfs:subClassOf {entity} .'
-        else:
-            for s in df.index:
-                yield f'{s} rdf:type {entity} .'
-
-        for name, attr in attrs.items():
-            p = attr.predicate
-
-            if attr.sep:
-                col = df[name].str.split(attr.sep).explode().dropna()
-            else:
-                col = df[name].dropna()
-
-            if isinstance((ns := attr.vtype), str): # Namespace
-                for s, o in zip(col.index, col.to_list()):
-                    yield f'{s} {p} {ns}:{o} .'
-
-            elif isinstance((rel := attr.vtype), Relation): # Related entity
-                df2 = col.str.extract(rel.pattern).dropna(subset=['identifier'])
-                entityName2 = rel.name
-
-                for s, id2 in zip(df2.index, df2.identifier.to_list()):
-                    yield f'{s} {p} loc:{entityName2}-{quote_plus(id2)} .'
-
-                yield from self.toRDF(df2, entityName2)
-
-            else:
-                for s, o in zip(col.index, col.to_list()):
-                    yield f'{s} {p} "{o}" .'
-
-    def pushDataToDb(self, path: str) -> bool:
+        if entityName != BASE:
+            new = ~df.index.duplicated() & ~df.index.isin(self._minted)
+            self.deduplicated += int(len(df) - new.sum())
+            df = df[new]
+            self._minted.update(df.index)
+        self._pushed += df.identifier.to_list()
+        return emitter(df, self._triples)
+
+    def _read(self, path: str) -> pd.DataFrame:
+        """
+        Reads a metadata file into a DataFrame of string columns named after the attributes of the base entity,
+        matched by position. The format is detected from the extension:
+        - CSV, optionally compressed (.csv, .csv.gz);
+        - Parquet, reading only the mapped columns (.parquet, needs pyarrow).
+        """
+        names = list(IDE[BASE]['attributes'])
+
+        if file_format(path) == 'parquet':
+            if pq is None:
+                raise ImportError('Reading Parquet files requires pyarrow.')
+            columns = pq.read_schema(path).names[:len(names)] # Column projection
+            df = pq.read_table(path, columns=columns).to_pandas().astype('string')
+            df.columns = names
+            return df
+
+        return pd.read_csv(
+            path,
+            header=0,
+            names=names,
+            dtype='string',
+            on_bad_lines='skip',
+            engine='c',
+            compression='infer',
+            memory_map=not path.lower().endswith('.gz'),
+        )
+
+    def _checkpoint(self, graph: Graph, subject: str) -> int:
+        """
+        Returns the number of batches of a source file committed so far, stored in the database.
+        """
+        rows = list(graph.query(f'SELECT ?n WHERE {{ {subject} loc:batches ?n . }}'))
+        return int(rows[0][0]) if rows else 0
+
+    def pushDataToDb(self, path: str, *, resume: bool = False) -> bool:
+        """
+        Pushes a metadata file in updates of at most batchSize rows, each one storing as well the number
+        of batches done so far. An update failing for an unreachable endpoint or a server error
+        is retried with exponential backoff.
+        With resume, the push continues after the last batch committed for the same file.
+        """
         if not (endpoint := self.getDbPathOrUrl()):
             print('Exception: Database path not set.')
             return False
@@ -113,27 +163,33 @@ class MetadataUploadHandler(UploadHandler):
             graph.bind(prefix, ns, override=False, replace=False)
 
         try:
-            df = pd.read_csv(
-                path,
-                header=0,
-                names=list(IDE[BASE]['attributes']),
-                dtype='string',
-                on_bad_lines='skip',
-                engine='c',
-                memory_map=True,
-            )
+            df = self._read(path)
         except FileNotFoundError as e:
             print(e)
             return False
+        except ImportError as e:
+            print(e)
+            return False
         except ValueError as e:
             print(e)
             return False
 
-        graph.update(f'INSERT DATA {{ {" ".join(self.toRDF(df))} }}')
+        self._reset()
+        # Checkpoint of the source file, a subject of the local namespace
+        subject = f'loc:checkpoint-{stable_hash(os.path.abspath(path)) & MAX_RANK:x}'
 
         try:
             store.open((endpoint, endpoint))
-            store.commit()
+            start = retry(lambda: self._checkpoint(graph, subject), self.retries, self.backoff) if resume else 0
+            for batches, offset in enumerate(range(start * self.batchSize, len(df), self.batchSize), start + 1):
+                triples = self._triples(df.iloc[offset:offset + self.batchSize].copy())
+                # Sent together as a single request, the checkpoint is replaced only if the data is stored
+                graph.update(f'DELETE WHERE {{ {subject} loc:batches ?n . }}')
+                graph.update(f'INSERT DATA {{ {" ".join(triples)} {subject} loc:batches {batches} . }}')
+                retry(store.commit, self.retries, self.backoff)
+                self._track(self._pushed)
+                self._notify(self._pushed)
+                self._pushed = []
         except URLError as e:
             print(e)
             store.rollback()
@@ -163,6 +219,7 @@ class MetadataUploadHandler(UploadHandler):
             store.rollback()
             return False
         else:
+            self.identifiers.clear()
             return True
         finally:
             store.close()
@@ -171,10 +228,18 @@ class MetadataQueryHandler(QueryHandler, metaclass=MapMeta):
     def __init__(self):
         super().__init__()
         self.sparql: Optional[SPARQLWrapper] = None
+        self.statistics: Optional[Dict[str, Any]] = None
+        # Identifiers recently not found by getById, remembered once following an upload handler,
+        # and optionally all the identifiers in the database
+        self.misses = MissCache(size=0)
+        self.known: Optional[BloomFilter] = None
 
     def setDbPathOrUrl(self, newDbPathOrUrl: str) -> bool:
         if not super().setDbPathOrUrl(newDbPathOrUrl): # Set new endpoint
             return False
+        self.statistics = None
+        self.misses.clear()
+        self.known = None
 
         # Initialize sparql wrapper around endpoint
         endpoint = self.getDbPathOrUrl()
@@ -208,13 +273,67 @@ class MetadataQueryHandler(QueryHandler, metaclass=MapMeta):
             return f'?s {predicate} ?x .'
 
     def _query(self, query: str) -> pd.DataFrame:
-        if not (wrapper := self.sparql):
+        if not self.sparql:
             raise Exception
+        wrapper = copy(self.sparql) # The query is set on a copy, so that concurrent queries do not mix
         wrapper.setQuery(query)
         result = wrapper.queryAndConvert()
         _csv = StringIO(result.decode('utf-8'))
         return pd.read_csv(_csv, sep=',', dtype='object')
 
+    def getStatistics(self, refresh: bool = False) -> Dict[str, Any]:
+        """
+        Returns cardinality statistics for query planning: the number of objects and of people,
+        and a histogram of the objects per author identifier.
+        They are computed by aggregate queries on first use and cached until refreshed.
+        """
+        if self.statistics is None or refresh:
+            count = "SELECT (COUNT(DISTINCT ?s) AS ?n) WHERE {{ {} }}"
+            objects = self._query(self.prefixes + count.format(' '.join(self.query_dict[BASE][1][:2])))
+            people = self._query(self.prefixes + count.format(self.query_dict['Person'][1][0]))
+            authors = self._query(
+                self.prefixes +
+                f"SELECT ?x (COUNT(DISTINCT ?s) AS ?n) WHERE {{ {self._filter_map(BASE, ('hasAuthor', 'identifier'))} }} GROUP BY ?x"
+            )
+            self.statistics = {
+                'objects': int(objects.iat[0, 0]),
+                'people': int(people.iat[0, 0]),
+                'hasAuthor': dict(zip(authors['x'], authors['n'].astype(int)))
+            }
+        return self.statistics
+
+    def loadKnownIdentifiers(self) -> bool:
+        """
+        Builds a Bloom filter of the identifiers of all the objects and people in the database:
+        getById answers identifiers outside of it as missing without querying.
+        """
+        try:
+            identifiers = np.concatenate([
+                self.getEntities(select_only='identifier'),
+                self.getEntities('Person', select_only='identifier')
+            ])
+        except Exception as e:
+            print(e)
+            return False
+        self.known = BloomFilter(identifiers, capacity=max(100000, 2 * len(identifiers)))
+        return True
+
+    def follow(self, handler: UploadHandler) -> bool:
+        """
+        Keeps the misses, and the known identifiers if loaded, up to date with the pushes of an upload handler
+        to the same database. Misses are remembered only from then on: otherwise new identifiers would be seen late.
+        """
+        if not self.misses.size:
+            self.misses = MissCache()
+        return handler.addListener(self._pushed)
+
+    def _pushed(self, identifiers: List[str]) -> None:
+        self.misses.discard(identifiers)
+        if self.known is not None:
+            self.known.update(identifiers)
+        self.statistics = None
+
+    @coalesced
     def getEntities(
         self,
         entityName: str = BASE,
@@ -234,6 +353,11 @@ WHERE {{
             select = ['?' + select_only]
             where = where[:1] + [triple for triple in where[1:] if select_only in triple or 'class' in triple]
 
+        else:
+            rank_triple, order_clause = self.order_by[entityName]
+            if rank_triple:
+                where.append(rank_triple)
+
         if by and value:
             value_clause = '\n        VALUES ?x {{ {} }}'
             condition = self._filter_map(entityName, by)
@@ -241,21 +365,27 @@ WHERE {{
             where.append(value_clause.format(id_join(value)))
 
         query = self.prefixes + select_clause.format(' '.join(select)) + where_clause.format('\n        '.join(where))
-        df = self._query(query)
-
         if select_only:
-            return df.iloc[:, 0].to_numpy()
+            return self._query(query).iloc[:, 0].to_numpy()
+
+        # Rows are sorted by the endpoint on the rank precomputed at ingest
+        df = self._query(query + order_clause)
 
         for col, uri in self.uri_strip[entityName]:
             df[col] = df[col].str.replace(uri, '')
 
-        cols_to_sort, sort_key = self.sort_by[entityName]
-        return df.sort_values(by=cols_to_sort, key=sort_key, ignore_index=True)
+        return df
 
     def getById(self, identifier: Some[str]) -> pd.DataFrame:
+        single = isinstance(identifier, str)
+        if single and (identifier in self.misses or (self.known is not None and identifier not in self.known)):
+            return pd.DataFrame()
+
         df = self.getEntities(by='identifier', value=identifier)
         if df.empty:
             df = self.getEntities('Person', by='identifier', value=identifier)
+        if single and df.empty:
+            self.misses.add(identifier)
         return df
 
     def getAllPeople(self) -> pd.DataFrame:
@@ -1,12 +1,69 @@
-from typing import Union, Any, List, Dict, Set, Mapping, Iterable
+from typing import Union, Any, List, Dict, Set, Mapping, Iterable, Generator, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from itertools import chain, islice
+from operator import itemgetter
+import heapq
+from threading import Thread
+from queue import Queue, Full
+from multiprocessing import get_context
+import os
 import pandas as pd
 import json
 import sqlite3
+from contextlib import closing, ExitStack
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet input is optional
+    pa = pq = None
 
 from streamlod.handlers.base import UploadHandler, QueryHandler
-from streamlod.utils import id_join, sorter
+from streamlod.utils import id_join, id_rank, rank, day_interval, day_condition, file_format, open_text, stable_hash, coalesced, retry
+
+# Repetitive string attributes stored as vocabulary ids in normalized databases
+ENCODED = ['class', 'technique', 'institute', 'person']
+
+# Longest identifier list inlined in a query by getById
+INLINE_IDS = 100
+
+def _is_normalized(con: sqlite3.Connection) -> bool:
+    """
+    Checks whether the database uses the dictionary-encoded schema.
+    """
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Vocabulary';"
+    return con.execute(query).fetchone() is not None
+
+def _shard_paths(db: str) -> List[str]:
+    """
+    Returns the paths of the shards of a database, listed in its Shard table,
+    or the database itself if it is not sharded.
+    """
+    with closing(sqlite3.connect(db)) as con:
+        if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Shard';").fetchone() is None:
+            return [db]
+        names = [row[0] for row in con.execute("SELECT path FROM Shard ORDER BY position;")]
+
+    # Shard paths are stored relative to the directory of the database
+    return [os.path.join(os.path.dirname(db), name) for name in names]
+
+def _shard_of(identifier: str, shards: int) -> int:
+    """
+    Position of the shard owning the activities on an object.
+    """
+    return stable_hash(identifier) % shards
+
+def _load(handlerClass: type, path: str, batchSize: int, start: int = 0) -> Optional[List[pd.DataFrame]]:
+    """
+    Worker task of pushManyToDb: parses a file with a new handler of the given class,
+    so that only plain settings are sent to the worker process, not the handler with its listeners.
+    """
+    handler = handlerClass()
+    handler.batchSize = batchSize
+    return handler._load(path, start)
 
 class ProcessDataUploadHandler(UploadHandler):
+    batchSize = 10000 # Objects per batch of streamed files
     _json_map = {
             'responsible institute': 'institute',
             'responsible person': 'person',
@@ -16,7 +73,21 @@ class ProcessDataUploadHandler(UploadHandler):
             'end date': 'end'
         }
 
-    def setDbPathOrUrl(self, newDbPathOrUrl: str, *, reset: bool = False) -> bool:
+    def setDbPathOrUrl(
+        self,
+        newDbPathOrUrl: str,
+        *,
+        reset: bool = False,
+        normalized: bool = False,
+        shards: int = 1
+    ) -> bool:
+        """
+        Sets the database path and creates the tables if they do not exist.
+        With normalized, repetitive string attributes and tools are stored as ids of a shared vocabulary table.
+        With more than one shard, activities are partitioned across as many database files by a hash
+        of the object they refer to: the given path holds the first shard and the list of all of them.
+        The schema and the shards of an existing database are kept as is: reset it to switch them.
+        """
         # Set the new database path
         if not super().setDbPathOrUrl(newDbPathOrUrl):
             return False
@@ -26,31 +97,100 @@ class ProcessDataUploadHandler(UploadHandler):
         db = self.getDbPathOrUrl()
         try:
             with sqlite3.connect(db) as con:
-                cursor = con.cursor()
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS Activity (
-                        internalId INTEGER PRIMARY KEY,
-                        class TEXT NOT NULL,
-                        refersTo TEXT NOT NULL,
-                        institute TEXT NOT NULL,
-                        person TEXT,
-                        technique TEXT,
-                        start TEXT,
-                        end TEXT
-                    );
-                ''')
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS Tool (
-                        activityId INTEGER,
-                        tool TEXT,
-                        FOREIGN KEY(activityId) REFERENCES Activity(internalId) ON DELETE CASCADE
-                    );
-                ''')
+                exists = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Activity';").fetchone()
+                if exists:
+                    normalized = _is_normalized(con)
+                elif shards > 1:
+                    root, ext = os.path.splitext(os.path.basename(db))
+                    names = [os.path.basename(db)] + [f'{root}.{position}{ext}' for position in range(1, shards)]
+                    con.execute('CREATE TABLE IF NOT EXISTS Shard (position INTEGER PRIMARY KEY, path TEXT NOT NULL);')
+                    con.executemany('INSERT OR REPLACE INTO Shard VALUES (?, ?);', enumerate(names))
+                # Batches of each source file committed so far, to resume an interrupted push
+                con.execute('CREATE TABLE IF NOT EXISTS Checkpoint (path TEXT PRIMARY KEY, batches INTEGER NOT NULL);')
+
+            for path in _shard_paths(db):
+                with sqlite3.connect(path) as con:
+                    self._create(con.cursor(), normalized)
+            self._index()
             return True
         except sqlite3.OperationalError as e:
             print(e)
             return False
 
+    def _stored(self) -> Iterable[str]:
+        """
+        Identifiers of the objects the stored activities refer to, read from every shard.
+        """
+        for path in _shard_paths(self.getDbPathOrUrl()):
+            with closing(sqlite3.connect(path)) as con:
+                yield from (row[0] for row in con.execute("SELECT DISTINCT refersTo FROM Activity;"))
+
+    def _create(self, cursor: sqlite3.Cursor, normalized: bool) -> None:
+        """
+        Creates the tables and indexes of a database or shard.
+        """
+        # Type of the encoded columns
+        text = 'INTEGER' if normalized else 'TEXT'
+
+        if normalized:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS Vocabulary (
+                    id INTEGER PRIMARY KEY,
+                    value TEXT NOT NULL UNIQUE
+                );
+            ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS Activity (
+                internalId INTEGER PRIMARY KEY,
+                class {text} NOT NULL,
+                refersTo TEXT NOT NULL,
+                institute {text} NOT NULL,
+                person {text},
+                technique {text},
+                start TEXT,
+                end TEXT,
+                idRank INTEGER NOT NULL,
+                classRank INTEGER NOT NULL,
+                startDay INTEGER,
+                endDay INTEGER,
+                contentHash INTEGER NOT NULL
+            );
+        ''')
+        # Natural key of the activities, which makes pushes idempotent
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS ActivityKey
+            ON Activity (refersTo, class, contentHash);
+        ''')
+        # Precomputed alphanumeric order of the activities, used by every query
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS ActivityOrder
+            ON Activity (idRank, refersTo, classRank);
+        ''')
+        # Dates as day ordinals for time range queries
+        cursor.execute('CREATE INDEX IF NOT EXISTS ActivityStart ON Activity (startDay);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ActivityEnd ON Activity (endDay);')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS Tool (
+                activityId INTEGER,
+                tool {text},
+                FOREIGN KEY(activityId) REFERENCES Activity(internalId) ON DELETE CASCADE
+            );
+        ''')
+        # Tools are fetched by activity id
+        cursor.execute('CREATE INDEX IF NOT EXISTS ToolActivity ON Tool (activityId);')
+        # Cardinality statistics for query planning, refreshed at push time
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Statistic (
+                attribute TEXT NOT NULL,
+                value TEXT,
+                count INTEGER NOT NULL
+            );
+        ''')
+        if normalized: # Partial names are matched on the vocabulary first, then looked up by id
+            for attribute in ENCODED:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS Activity_{attribute} ON Activity ({attribute});')
+            cursor.execute('CREATE INDEX IF NOT EXISTS Tool_tool ON Tool (tool);')
+
     def _validate(self, df: pd.DataFrame) -> pd.DataFrame:
         # Reshape DataFrame with attributes as columns
         df.columns = df.columns.str.capitalize().str.split('.', expand=True)
@@ -80,53 +220,416 @@ class ProcessDataUploadHandler(UploadHandler):
             )
         )
 
-        return df[mask]
+        df = df[mask]
 
-    def pushDataToDb(self, path: str) -> bool:
-        if not (db := self.getDbPathOrUrl()):
-            print('Exception: Database path not set.')
-            return False
+        return self._keys(df)
+
+    def _keys(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds to valid activities their sorting keys, their dates as intervals of days and their content hash.
+        """
+        # Store the sorting keys of the activities along with them
+        df.insert(7, 'idRank', df['refersTo'].map(id_rank))
+        df.insert(8, 'classRank', df['class'].map(rank))
+
+        # Store the dates as intervals of days: activities start on the first day and end on the last one
+        df.insert(9, 'startDay', df['start'].map(lambda x: day_interval(x)[0], na_action='ignore').astype('Int64'))
+        df.insert(10, 'endDay', df['end'].map(lambda x: day_interval(x)[1], na_action='ignore').astype('Int64'))
 
-        # Load the JSON file
+        # Hash the content of the activities to complete their natural key (refersTo, class)
+        content = df[['technique', 'institute', 'person', 'start', 'end']].fillna('').agg('\x1f'.join, axis=1) + '\x1f' + \
+                  df['tool'].map(lambda tools: '\x1e'.join(sorted(tools)), na_action='ignore').fillna('')
+        df.insert(11, 'contentHash', content.map(stable_hash))
+
+        return df
+
+    def _encode(self, cursor: sqlite3.Cursor, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Replaces the values of the encoded attributes and tools with their vocabulary ids,
+        adding the new values to the vocabulary.
+        """
+        values = pd.concat([df[attribute] for attribute in ENCODED] + [df['tool'].explode()]).dropna().unique()
+        cursor.executemany("INSERT OR IGNORE INTO Vocabulary (value) VALUES (?)", ((value,) for value in values))
+        vocabulary = dict(cursor.execute("SELECT value, id FROM Vocabulary;").fetchall())
+
+        df = df.copy()
+        for attribute in ENCODED:
+            df[attribute] = df[attribute].map(vocabulary).astype('Int64')
+        df['tool'] = df['tool'].map(lambda tools: [vocabulary[tool] for tool in tools], na_action='ignore')
+
+        return df
+
+    def _read(self, path: str, chunksize: int = 10000) -> Generator[pd.DataFrame, None, None]:
+        """
+        Reads a process data file into flattened DataFrames of at most chunksize objects,
+        with the same dotted column names whatever the input format, detected from the extension:
+        - a JSON array document (.json, .json.gz), loaded whole and then split;
+        - JSON Lines, one object per line, streamed (.jsonl, .jsonl.gz);
+        - Parquet with one struct column per activity, streamed by row batches (.parquet, needs pyarrow).
+        """
+        match file_format(path):
+            case 'parquet':
+                if pq is None:
+                    raise ImportError('Reading Parquet files requires pyarrow.')
+                file = pq.ParquetFile(path)
+                # Project only the object id and the activity columns
+                names = file.schema_arrow.names
+                columns = [name for name in names if name.lower() == 'object id'] + \
+                          [name for name in names if name.capitalize() in rank]
+                for batch in file.iter_batches(batch_size=chunksize, columns=columns):
+                    yield pa.Table.from_batches([batch]).flatten().to_pandas()
+
+            case 'jsonl':
+                with open_text(path) as file:
+                    records = []
+                    for line in file:
+                        if line.strip():
+                            records.append(json.loads(line))
+                        if len(records) == chunksize:
+                            yield pd.json_normalize(records)
+                            records = []
+                    if records:
+                        yield pd.json_normalize(records)
+
+            case _:
+                # Load the JSON document
+                with open_text(path) as file:
+                    json_doc = json.load(file)
+                if isinstance(json_doc, dict): # A single object
+                    json_doc = [json_doc]
+                # Flatten the JSON document into DataFrames, in chunks as the streamed formats
+                for start in range(0, len(json_doc), chunksize):
+                    yield pd.json_normalize(json_doc[start:start + chunksize])
+
+    def _batches(self, path: str, start: int = 0) -> Generator[pd.DataFrame, None, None]:
+        """
+        Yields the validated activities of a process data file, one batch at a time, from the batch start.
+        """
+        for df in islice(self._read(path, self.batchSize), start, None):
+            if not df.empty:
+                yield self._validate(df)
+
+    def _load(self, path: str, start: int = 0) -> Optional[List[pd.DataFrame]]:
+        """
+        Parses a process data file into batches of validated activities, from the batch start.
+        Returns None if the file cannot be read.
+        """
         try:
-            with open(path, 'r', encoding='utf-8') as file:
-                json_doc = json.load(file)
-        except IOError as e:
+            return list(self._batches(path, start))
+        except (IOError, ImportError) as e:
             print(e)
-            return False
-        except json.JSONDecodeError as e: # Not a valid JSON document
+            return None
+        except ValueError as e: # Not a valid JSON or Parquet document
             print(e)
-            return False
+            return None
+
+    def _insert(self, con: sqlite3.Connection, df: pd.DataFrame) -> None:
+        """
+        Inserts validated activities and their tools in the database in bulk, and adds the inserted ones to the statistics.
+        Activities are staged in a temporary table and copied with a single statement, skipping the ones already stored;
+        the new ones, above the largest id before the copy, are then matched back to their rows on the natural key.
+        """
+        columns = 'class, refersTo, technique, institute, person, start, end, idRank, classRank, startDay, endDay, contentHash'
+        cursor = con.cursor()
+        stored = self._encode(cursor, df) if _is_normalized(con) else df
+        array = stored.to_numpy(dtype=object, na_value=None)
+
+        # New activities get ids above the current largest one
+        last = cursor.execute("SELECT COALESCE(MAX(internalId), 0) FROM Activity;").fetchone()[0]
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS Staging (position INTEGER PRIMARY KEY, {columns});")
+        cursor.executemany(
+            f"INSERT INTO temp.Staging VALUES ({', '.join(['?'] * 13)});",
+            ((position, *row[:-1]) for position, row in enumerate(array))
+        )
+        # Activities already stored, or repeated in the batch, are skipped together with their tools
+        cursor.execute(f"""
+            INSERT INTO Activity ({columns})
+            SELECT {columns} FROM temp.Staging WHERE true ORDER BY position
+            ON CONFLICT DO NOTHING;""")
+        cursor.execute("DROP TABLE temp.Staging;")
+        rows = cursor.execute("SELECT internalId, refersTo, class, contentHash FROM Activity WHERE internalId > ?;", (last,)).fetchall()
+        if not rows:
+            return
+
+        # Each new activity comes from the first row of the batch with its natural key
+        keys = ['refersTo', 'class', 'contentHash']
+        first = stored[keys].reset_index(drop=True).drop_duplicates()
+        positions = first.index[pd.MultiIndex.from_frame(first).get_indexer(pd.MultiIndex.from_tuples([row[1:] for row in rows]))]
+
+        # Activities without tools get no Tool rows, they are recovered by the left join on read
+        cursor.executemany(
+            "INSERT INTO Tool (activityId, tool) VALUES (?, ?);",
+            ((row[0], tool) for row, position in zip(rows, positions) for tool in (array[position][-1] or ()))
+        )
+        self._update(con, df.iloc[positions])
 
-        # Flatten the JSON document into a DataFrame
-        df = pd.json_normalize(json_doc)
-        array = self._validate(df).to_numpy(dtype=object, na_value=None)
+    def insertActivities(self, con: sqlite3.Connection, df: pd.DataFrame) -> None:
+        """
+        Inserts valid activities, such as the ones returned by a query handler, in the transaction of the caller.
+        """
+        self._insert(con, self._keys(df))
 
-        activity_query = f"INSERT INTO Activity (class, refersTo, technique, institute, person, start, end) VALUES (?, ?, ?, ?, ?, ?, ?)"
-        tool_query = "INSERT INTO Tool (activityId, tool) VALUES (?, ?)"
+    def discountActivities(self, con: sqlite3.Connection, df: pd.DataFrame) -> None:
+        """
+        Removes from the statistics the activities deleted by the caller in the same transaction.
+        """
+        self._update(con, df, -1)
 
+    def _update(self, con: sqlite3.Connection, df: pd.DataFrame, sign: int = 1) -> None:
+        """
+        Updates the statistics in the transaction of a write, without failing it: statistics are only estimates.
+        If they cannot be updated, they are recomputed by the next write.
+        """
+        con.execute("SAVEPOINT Statistics;")
         try:
-            with sqlite3.connect(db) as con:
-                cursor = con.cursor()
-                for row in array:
-                    cursor.execute(activity_query,(row[:-1]))
-                    internalId = cursor.lastrowid
-                    if (tools := row[-1]):
-                        cursor.executemany(tool_query, [(internalId, tool) for tool in tools])
-                    else:
-                        cursor.execute(tool_query, (internalId, None))
+            self._count(con, df, sign)
+        except Exception as e:
+            print(e)
+            con.execute("ROLLBACK TO Statistics;")
+            con.execute("DELETE FROM Statistic WHERE attribute = 'activities';")
+        con.execute("RELEASE Statistics;")
+
+    def _count(self, con: sqlite3.Connection, df: pd.DataFrame, sign: int = 1) -> None:
+        """
+        Adds to the statistics of a database or shard the activities just inserted,
+        or with a negative sign subtracts the activities of objects just deleted whole.
+        Statistics missing or dropped by a failed update are recomputed from the tables instead.
+        """
+        if con.execute("SELECT 1 FROM Statistic WHERE attribute = 'activities';").fetchone() is None:
+            return self._analyze(con)
+
+        if sign > 0: # Objects without activities stored before this batch
+            counts = df['refersTo'].value_counts()
+            query = "SELECT COUNT(*) FROM Activity WHERE refersTo = ?;"
+            objects = sum(con.execute(query, (identifier,)).fetchone()[0] == count for identifier, count in counts.items())
+        else:
+            objects = df['refersTo'].nunique()
+
+        rows = [('activities', None, len(df)), ('objects', None, objects)]
+        for attribute in ENCODED:
+            rows += [(attribute, None if pd.isna(value) else value, count) for value, count in df[attribute].value_counts(dropna=False).items()]
+        tools = df['tool'].dropna().map(set).explode().dropna().value_counts()
+        rows += [('tool', value, count) for value, count in tools.items()]
+
+        for attribute, value, count in rows:
+            parameters = (sign * int(count), attribute, value)
+            if not con.execute("UPDATE Statistic SET count = count + ? WHERE attribute = ? AND value IS ?;", parameters).rowcount:
+                con.execute("INSERT INTO Statistic (count, attribute, value) VALUES (?, ?, ?);", parameters)
+        con.execute("DELETE FROM Statistic WHERE count <= 0 AND value IS NOT NULL;")
+
+    def _connect(self, stack: ExitStack) -> List[sqlite3.Connection]:
+        """
+        Opens a connection to every shard of the database, in shard order.
+        Connections are closed, and their transactions committed or rolled back, when the stack exits.
+        """
+        cons = []
+        for path in _shard_paths(self.getDbPathOrUrl()):
+            con = stack.enter_context(closing(sqlite3.connect(path)))
+            cons.append(stack.enter_context(con))
+        return cons
+
+    def _distribute(self, cons: List[sqlite3.Connection], df: pd.DataFrame) -> None:
+        """
+        Inserts validated activities in the shards owning them.
+        """
+        if len(cons) == 1:
+            self._insert(cons[0], df)
+        else:
+            positions = df['refersTo'].map(lambda identifier: _shard_of(identifier, len(cons)))
+            for position, part in df.groupby(positions):
+                self._insert(cons[position], part)
+
+    def _analyze(self, con: sqlite3.Connection) -> None:
+        """
+        Recomputes the statistics of a database or shard: the number of activities and of distinct objects,
+        and the number of activities per value of the encoded attributes and per tool.
+        Writes keep them up to date afterwards.
+        """
+        normalized = _is_normalized(con)
+        def value(table: str, column: str) -> str:
+            return f'(SELECT value FROM Vocabulary WHERE id = {table}.{column})' if normalized else f'{table}.{column}'
+
+        con.execute("DELETE FROM Statistic;")
+        con.execute("INSERT INTO Statistic SELECT 'activities', NULL, COUNT(*) FROM Activity;")
+        con.execute("INSERT INTO Statistic SELECT 'objects', NULL, COUNT(DISTINCT refersTo) FROM Activity;")
+        for attribute in ENCODED:
+            con.execute(f"INSERT INTO Statistic SELECT '{attribute}', {value('A', attribute)}, COUNT(*) FROM Activity AS A GROUP BY A.{attribute};")
+        con.execute(f"INSERT INTO Statistic SELECT 'tool', {value('T', 'tool')}, COUNT(DISTINCT T.activityId) FROM Tool AS T GROUP BY T.tool;")
+
+    def _commit(self, cons: List[sqlite3.Connection], df: pd.DataFrame, source: str, batches: int) -> None:
+        """
+        Inserts a batch and commits it together with the checkpoint of its source file.
+        The checkpoint is in the first database, committed last: a failure in between only makes
+        a resumed push insert the batch again, which skips the activities already stored.
+        """
+        try:
+            self._distribute(cons, df)
+            cons[0].execute("INSERT OR REPLACE INTO Checkpoint VALUES (?, ?);", (source, batches))
+            for con in reversed(cons):
+                con.commit()
+        except Exception:
+            for con in cons:
+                con.rollback()
+            raise
+
+    def pushDataToDb(self, path: str, *, resume: bool = False) -> bool:
+        """
+        Pushes a process data file, committing one batch at a time with the number of batches done so far.
+        A batch failing for a busy or locked database is retried with exponential backoff.
+        With resume, the push continues after the last batch committed for the same file.
+        """
+        if not self.getDbPathOrUrl():
+            print('Exception: Database path not set.')
+            return False
+
+        source = os.path.abspath(path)
+        pushed = []
+        try:
+            with ExitStack() as stack:
+                cons = self._connect(stack)
+                start = 0
+                if resume and (row := cons[0].execute("SELECT batches FROM Checkpoint WHERE path = ?;", (source,)).fetchone()):
+                    start = row[0]
+                for batches, df in enumerate(self._batches(path, start), start + 1):
+                    retry(lambda: self._commit(cons, df, source, batches), self.retries, self.backoff)
+                    pushed += df['refersTo'].to_list()
             return True
 
+        except (IOError, ImportError) as e:
+            print(e)
+            return False
         except sqlite3.OperationalError as e:
             print(e)
             return False
+        except ValueError as e: # Not a valid JSON or Parquet document
+            print(e)
+            return False
+        finally: # Committed batches are pushed even if a later one failed
+            self._track(pushed)
+            if pushed:
+                self._notify(pushed)
+
+    def _write(self, batches: Queue, failed: List[str], pushed: List[str]) -> None:
+        """
+        Single writer: inserts the files taken from the queue until the None sentinel,
+        committing them one batch at a time with their checkpoints, as pushDataToDb.
+        A file whose batch cannot be inserted is recorded as failed after its committed batches,
+        and the queue is drained in any case, so that the producer is never left blocked.
+        """
+        with ExitStack() as stack:
+            try:
+                cons = self._connect(stack)
+            except sqlite3.Error as e:
+                print(e)
+                cons = None
+            while (item := batches.get()) is not None:
+                path, start, dfs = item
+                if cons is None:
+                    failed.append(path)
+                    continue
+                source = os.path.abspath(path)
+                try:
+                    for batch, df in enumerate(dfs, start + 1):
+                        retry(lambda: self._commit(cons, df, source, batch), self.retries, self.backoff)
+                        pushed += df['refersTo'].to_list()
+                except Exception as e: # Any failure of a file must not stop the writer
+                    print(e)
+                    failed.append(path)
+
+    def pushManyToDb(
+        self,
+        paths: Iterable[str],
+        *,
+        workers: Optional[int] = None,
+        queue_size: int = 4,
+        resume: bool = False
+    ) -> bool:
+        """
+        Pushes many process JSON files at once.
+        Files are parsed and validated in a pool of worker processes, while the validated activities
+        are fed through a bounded queue to a single writer thread doing the inserts, so that SQLite
+        still sees one writer only. At most queue_size parsed files wait for the writer at any time.
+        Batches are committed, retried and resumed as in pushDataToDb.
+        Returns True only if every file was pushed.
+        """
+        if not (db := self.getDbPathOrUrl()):
+            print('Exception: Database path not set.')
+            return False
+
+        checkpoints: Dict[str, int] = {}
+        if resume:
+            try:
+                with closing(sqlite3.connect(db)) as con:
+                    checkpoints = dict(con.execute("SELECT path, batches FROM Checkpoint;").fetchall())
+            except sqlite3.OperationalError as e:
+                print(e)
+                return False
+
+        workers = workers or os.cpu_count() or 1
+        batches = Queue(maxsize=queue_size)
+        failed: List[str] = []
+        pushed: List[str] = []
+        futures_paths: Dict[Future, tuple[str, int]] = {}
+        writer = Thread(target=self._write, args=(batches, failed, pushed))
+        writer.start()
+
+        def put(item: Any) -> bool:
+            """
+            Puts an item in the queue, blocking while the writer is behind, unless the writer has stopped.
+            """
+            while writer.is_alive():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def collect(futures: Iterable[Future]) -> None:
+            for future in futures:
+                path, start = futures_paths.pop(future)
+                try:
+                    dfs = future.result()
+                except Exception as e: # Unexpected failure of the worker
+                    print(e)
+                    dfs = None
+                if dfs is None or not put((path, start, dfs)):
+                    failed.append(path)
+
+        try:
+            # Workers are started while the writer thread runs: forking then could copy its held locks
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+                # Limit the files being parsed, so that finished ones do not pile up in memory
+                window = workers + queue_size
+                for path in paths:
+                    start = checkpoints.get(os.path.abspath(path), 0)
+                    futures_paths[executor.submit(_load, type(self), path, self.batchSize, start)] = path, start
+                    if len(futures_paths) >= window:
+                        done, _ = wait(futures_paths, return_when=FIRST_COMPLETED)
+                        collect(done)
+                collect(as_completed(list(futures_paths)))
+        finally:
+            put(None)
+            writer.join()
+            self._track(pushed)
+            if pushed:
+                self._notify(pushed)
+
+        return not failed
 
     def clearDb(self) -> bool:
         db = self.getDbPathOrUrl()
         try:
+            for path in _shard_paths(db):
+                with sqlite3.connect(path) as con:
+                    con.execute(f"DROP TABLE IF EXISTS Activity;")
+                    con.execute(f"DROP TABLE IF EXISTS Tool;")
+                    con.execute(f"DROP TABLE IF EXISTS Vocabulary;")
+                    con.execute(f"DROP TABLE IF EXISTS Statistic;")
             with sqlite3.connect(db) as con:
-                con.execute(f"DROP TABLE IF EXISTS Activity;")
-                con.execute(f"DROP TABLE IF EXISTS Tool;")
+                con.execute(f"DROP TABLE IF EXISTS Shard;")
+                con.execute(f"DROP TABLE IF EXISTS Checkpoint;")
+            self.identifiers.clear()
             return True
         except sqlite3.OperationalError as e:
             print(e)
@@ -134,6 +637,74 @@ class ProcessDataUploadHandler(UploadHandler):
 
 class ProcessDataQueryHandler(QueryHandler):
 
+    def __init__(self):
+        super().__init__()
+        self._normalized: Optional[bool] = None # Schema of the database, read on first use
+
+    def setDbPathOrUrl(self, pathOrUrl: str) -> bool:
+        self._normalized = None
+        return super().setDbPathOrUrl(pathOrUrl)
+
+    def isNormalized(self) -> bool:
+        """
+        Tells whether the database uses the dictionary-encoded schema.
+        The schema is read once, as soon as the database exists: set the path again after resetting it with another schema.
+        """
+        if self._normalized is None:
+            with closing(sqlite3.connect(self.getDbPathOrUrl())) as con:
+                if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Activity';").fetchone() is None:
+                    return False
+                self._normalized = _is_normalized(con)
+        return self._normalized
+
+    def _vocabulary(self, con: sqlite3.Connection) -> Optional[Dict[int, str]]:
+        """
+        Returns the vocabulary of a normalized database or shard by id, None for the plain schema.
+        """
+        return dict(con.execute("SELECT id, value FROM Vocabulary;").fetchall()) if self.isNormalized() else None
+
+    def likeCondition(self, attribute: str, partialName: str, partial: bool = True) -> str:
+        """
+        Builds a case-insensitive match condition on an activity attribute or on the tool column.
+        In normalized databases the name is matched against the small vocabulary table first,
+        and the attribute is then filtered by the matching ids.
+        """
+        pattern = f"'%{partialName}%'" if partial else f"'{partialName}'"
+
+        if self.isNormalized():
+            return f"{attribute} IN (SELECT id FROM Vocabulary WHERE value LIKE {pattern})"
+        else:
+            return f"{attribute} LIKE {pattern}"
+
+    def iterAttribute(
+        self,
+        attribute: str = 'refersTo',
+        condition: str = '',
+        chunksize: int = 1000
+    ) -> Generator[List[Any], None, None]:
+        """
+        Streams the values of a column of the main activity table for the rows that match the condition,
+        in lists of at most chunksize values fetched from a database cursor.
+        """
+        for db in _shard_paths(self.getDbPathOrUrl()):
+            with closing(sqlite3.connect(db)) as con:
+                column = attribute
+                if attribute in ENCODED and self.isNormalized(): # Resolve the vocabulary id back to its value
+                    column = f'(SELECT value FROM Vocabulary WHERE id = A.{attribute})'
+                query = f"""
+                    SELECT {column}
+                    FROM Activity AS A
+                    {condition};"""
+                try:
+                    cursor = con.execute(query)
+                except sqlite3.OperationalError as e: # Attribute column does not exist, or the shard cannot be read
+                    print(e)
+                    continue
+
+                while (rows := cursor.fetchmany(chunksize)):
+                    yield [row[0] for row in rows]
+
+    @coalesced
     def getAttribute(
         self,
         attribute: str = 'refersTo',
@@ -142,73 +713,234 @@ class ProcessDataQueryHandler(QueryHandler):
         """
         Performs a query to retrieve the values of a column of the main activity table for the rows that match the condition.
         """
-        db = self.getDbPathOrUrl()
+        return list(chain.from_iterable(self.iterAttribute(attribute, condition, chunksize=10000)))
 
-        with sqlite3.connect(db) as con:
-            cursor = con.cursor()
-            query = f"""
-                SELECT {attribute}
-                FROM Activity
-                {condition};"""
-            # Execute the combined query and fetch the results
-            try:
-                result = cursor.execute(query).fetchall()
-            except sqlite3.OperationalError: # Attribute column does not exist
-                return []
+    def countActivities(self, condition: str = '') -> int:
+        """
+        Counts the activities matching the condition over every shard, using the indexes of the condition columns.
+        """
+        count = 0
+        for db in _shard_paths(self.getDbPathOrUrl()):
+            with closing(sqlite3.connect(db)) as con:
+                count += con.execute(f"SELECT COUNT(*) FROM Activity AS A {condition};").fetchone()[0]
+        return count
+
+    @coalesced
+    def getStatistics(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cardinality statistics computed at push time, summed over the shards:
+        the number of activities and of distinct objects, and a histogram of the activities
+        per value of each encoded attribute and of the tools.
+        Returns None if the database has no statistics.
+        """
+        result: Dict[str, Any] = {'activities': 0, 'objects': 0}
+        for db in _shard_paths(self.getDbPathOrUrl()):
+            with closing(sqlite3.connect(db)) as con:
+                try:
+                    rows = con.execute("SELECT attribute, value, count FROM Statistic;").fetchall()
+                except sqlite3.OperationalError: # Database created before statistics
+                    return None
+            for attribute, value, count in rows:
+                if attribute == 'activities' or attribute == 'objects':
+                    result[attribute] += count
+                else:
+                    histogram = result.setdefault(attribute, {})
+                    histogram[value] = histogram.get(value, 0) + count
+        return result
+
+    def estimate(self, attribute: str, partialName: str = '', partial: bool = True) -> Optional[int]:
+        """
+        Estimates from the statistics the number of activities matching likeCondition on an attribute or tool.
+        """
+        if (statistics := self.getStatistics()) is None:
+            return None
+        name = partialName.lower()
+        return sum(
+            count for value, count in statistics.get(attribute, {}).items()
+            if value is not None and (name in value.lower() if partial else name == value.lower())
+        )
 
-        # Return a list of the attribute values
-        return [row[0] for row in result]
+    _columns = 'internalId, class, refersTo, technique, institute, person, start, end, idRank, classRank'
+    _order = 'ORDER BY A.idRank, A.refersTo, A.classRank, A.internalId'
+    _keys = ['idRank', 'refersTo', 'classRank']
 
+    def _link(self, df: pd.DataFrame, tools: pd.DataFrame, vocabulary: Optional[Dict[int, str]] = None) -> pd.DataFrame:
+        """
+        Links each activity to the set of its tools, resolving vocabulary ids with the vocabulary of normalized databases.
+        """
+        if vocabulary is not None: # Resolve the vocabulary ids back to their values
+            for attribute in ENCODED:
+                df[attribute] = df[attribute].map(vocabulary.get)
+            tools['tool'] = tools['tool'].map(vocabulary.get)
+
+        # Collect the tools of each activity in a set and left join them on the activity id
+        tools = tools.groupby('activityId', sort=False)['tool'].agg(set)
+        df = df.join(tools, on='internalId').drop(columns='internalId')
+        df['tool'] = df['tool'].astype(object).where(df['tool'].notna(), None)
+
+        return df
+
+    def _getShardActivities(self, db: str, condition: str, identifiers: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Retrieves the sorted activities of a single database or shard, with their sorting keys.
+        The identifiers, if any, are loaded in the temporary Ids table the condition can refer to.
+        """
+        activity_query = f"""
+            SELECT {self._columns}
+            FROM Activity AS A
+            {condition}
+            {self._order};
+            """
+        # Tools are fetched by activity id in a second query instead of being concatenated in a string and split back
+        tool_query = f"""
+            SELECT activityId, tool
+            FROM Tool
+            WHERE tool IS NOT NULL AND activityId IN (
+                SELECT internalId
+                FROM Activity AS A
+                {condition}
+            );
+            """
+        with closing(sqlite3.connect(db)) as con: # Closing drops the temporary table
+            if identifiers is not None:
+                con.execute("CREATE TEMP TABLE Ids (id TEXT PRIMARY KEY) WITHOUT ROWID;")
+                con.executemany("INSERT OR IGNORE INTO temp.Ids VALUES (?);", ((identifier,) for identifier in identifiers))
+            df = pd.read_sql_query(activity_query, con, dtype='object')
+            tools = pd.read_sql_query(tool_query, con, dtype='object')
+            return self._link(df, tools, self._vocabulary(con))
+
+    @coalesced
     def getActivities(
         self,
-        condition: str = ''
+        condition: str = '',
+        shards: Optional[Iterable[int]] = None,
+        identifiers: Optional[List[str]] = None
     ) -> pd.DataFrame:
         """
         Retrieves data from the main activity table, linking each activity to its associated tools and applying an optional filter condition.
+        The condition can refer to the temporary table Ids of the given identifiers.
+        On sharded databases the query runs on all the shards, or on the given positions only, in parallel,
+        and the already sorted results are merged.
         If no valid activities are found, an empty DataFrame is returned.
         """
-        activities = {}
-        db = self.getDbPathOrUrl()
-
-        query = f"""
-            SELECT class, refersTo, technique, institute, person, start, end, GROUP_CONCAT(T.tool) AS tool
+        paths = _shard_paths(self.getDbPathOrUrl())
+        if shards is not None:
+            paths = [paths[position] for position in sorted(shards)]
+
+        if len(paths) == 1:
+            # Rows are already sorted alphanumerically by the database
+            df = self._getShardActivities(paths[0], condition, identifiers)
+        else:
+            with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+                dfs = list(executor.map(lambda db: self._getShardActivities(db, condition, identifiers), paths))
+            df = pd.concat(dfs, ignore_index=True)
+            df = df.sort_values(by=self._keys, kind='stable', ignore_index=True)
+
+        return df.drop(columns=['idRank', 'classRank'])
+
+    def _iterShardActivities(
+        self,
+        db: str,
+        condition: str,
+        chunksize: int,
+        sort: bool
+    ) -> Generator[pd.DataFrame, None, None]:
+        """
+        Streams the activities of a single database or shard from one cursor, with their sorting keys.
+        """
+        activity_query = f"""
+            SELECT {self._columns}
             FROM Activity AS A
-            JOIN Tool AS T
-            ON A.internalId = T.activityId
             {condition}
-            GROUP BY A.internalId;
+            {self._order if sort else ''};
             """
-        with sqlite3.connect(db) as con:
-            df = pd.read_sql_query(query, con, dtype='object')
-
-        # Split tool combined string in a set
-        df.tool = df.tool.apply(lambda x: set(x.split(',')) if x else None)
-
-        # Sort alphanumerically the index
-        return df.sort_values(by=['refersTo', 'class'], key=sorter)
+        tool_query = """
+            SELECT activityId, tool
+            FROM Tool
+            WHERE tool IS NOT NULL AND activityId IN ({});
+            """
+        with closing(sqlite3.connect(db)) as con:
+            vocabulary = self._vocabulary(con) # Loaded once for the whole stream
+            cursor = con.execute(activity_query)
+            columns = [description[0] for description in cursor.description]
+
+            while (rows := cursor.fetchmany(chunksize)):
+                df = pd.DataFrame(rows, columns=columns, dtype=object)
+                # Tools of the chunk only, looked up by activity id on a separate cursor
+                ids = ', '.join(str(row[0]) for row in rows)
+                tools = pd.read_sql_query(tool_query.format(ids), con, dtype='object')
+                yield self._link(df, tools, vocabulary)
+
+    def iterActivities(
+        self,
+        condition: str = '',
+        *,
+        chunksize: int = 10000,
+        sort: bool = True,
+        records: bool = False
+    ) -> Generator[Union[pd.DataFrame, List[tuple]], None, None]:
+        """
+        Streams the activities matching the condition in chunks fetched from a database cursor,
+        so that tables larger than memory can be processed one batch at a time.
+        If sort, rows come already ordered by the indexed sorting key, otherwise in storage order.
+        On sharded databases the sorted streams of the shards are merged row by row.
+        Yields DataFrames with the same columns as getActivities, or lists of row tuples if records.
+        """
+        paths = _shard_paths(self.getDbPathOrUrl())
+        streams = [self._iterShardActivities(db, condition, chunksize, sort) for db in paths]
+
+        if len(streams) == 1 or not sort:
+            chunks = chain.from_iterable(streams)
+        else:
+            def rows(stream: Iterable[pd.DataFrame]) -> Iterable[tuple]:
+                for df in stream:
+                    yield from df.itertuples(index=False, name=None)
+
+            # Rows are tuples of class, refersTo, ..., idRank, classRank, tool
+            merged = heapq.merge(*(rows(stream) for stream in streams), key=itemgetter(-3, 1, -2))
+            columns = ['class', 'refersTo', 'technique', 'institute', 'person', 'start', 'end', 'idRank', 'classRank', 'tool']
+            chunks = (
+                pd.DataFrame(batch, columns=columns, dtype=object)
+                for batch in iter(lambda: list(islice(merged, chunksize)), [])
+            )
 
-    def getById(self, identifier: Union[str, List[str]]) -> pd.DataFrame:
+        for df in chunks:
+            df = df.drop(columns=['idRank', 'classRank'])
+            yield list(df.itertuples(index=False, name=None)) if records else df
+
+    def getById(self, identifier: Union[str, int, List[str]]) -> pd.DataFrame:
+        # On sharded databases only the shards owning the identifiers are queried
+        # Sorted, so that the same set of identifiers always makes the same query, as strings like the stored ones
+        identifiers = [str(identifier)] if isinstance(identifier, (str, int)) else sorted({str(id) for id in identifier})
+        shards = len(_shard_paths(self.getDbPathOrUrl()))
+        positions = {_shard_of(identifier, shards) for identifier in identifiers} if shards > 1 and identifiers else None
+        if len(identifiers) > INLINE_IDS: # Large sets are loaded in a temporary table instead of a long literal list
+            return self.getActivities(condition='WHERE A.refersTo IN temp.Ids', shards=positions, identifiers=identifiers)
         # Normalize identifiers to a string
-        identifier = id_join(identifier, ', ')
-        return self.getActivities(condition=f'WHERE A.refersTo IN ({identifier})')
+        identifier = id_join(identifiers, ', ')
+        return self.getActivities(condition=f'WHERE A.refersTo IN ({identifier})', shards=positions)
 
     def getAllActivities(self) -> pd.DataFrame:
         return self.getActivities()
 
     def getActivitiesByResponsibleInstitution(self, partialName: str) -> pd.DataFrame:
-        return self.getActivities(condition=f"WHERE A.institute LIKE '%{partialName}%'")
+        return self.getActivities(condition=f"WHERE {self.likeCondition('A.institute', partialName)}")
 
     def getActivitiesByResponsiblePerson(self, partialName: str) -> pd.DataFrame:
-        return self.getActivities(condition=f"WHERE A.person LIKE '%{partialName}%'")
+        return self.getActivities(condition=f"WHERE {self.likeCondition('A.person', partialName)}")
 
     def getActivitiesUsingTool(self, partialName: str) -> pd.DataFrame:
-        return self.getActivities(condition=f"WHERE T.tool LIKE '%{partialName}%'")
+        return self.getActivities(
+            condition=f"WHERE A.internalId IN (SELECT activityId FROM Tool WHERE {self.likeCondition('tool', partialName)})"
+        )
 
     def getActivitiesStartedAfter(self, date: str) -> pd.DataFrame:
-        return self.getActivities(condition=f"WHERE A.start >= '{date}'")
+        return self.getActivities(condition=f"WHERE {day_condition('A.start', date)}")
 
     def getActivitiesEndedBefore(self, date: str) -> pd.DataFrame:
-        return self.getActivities(condition=f"WHERE A.end <= '{date}'")
+        return self.getActivities(condition=f"WHERE {day_condition('A.end', date, after=False)}")
 
     def getAcquisitionsByTechnique(self, partialName: str) -> pd.DataFrame:
-        return self.getActivities(condition=f"WHERE A.class LIKE 'Acquisition' AND A.technique LIKE '%{partialName}%'")
\ No newline at end of file
+        return self.getActivities(
+            condition=f"WHERE {self.likeCondition('A.class', 'Acquisition', partial=False)} AND {self.likeCondition('A.technique', partialName)}"
+        )
\ No newline at end of file
@@ -0,0 +1,121 @@
+from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import deque
+from functools import partial
+from threading import Lock
+from inspect import isgeneratorfunction
+from time import perf_counter
+
+from streamlod.handlers.base import QueryHandler
+
+class ReplicaGroup:
+    """
+    A group of query handlers over replicas of the same data, registered in a mashup as a single handler.
+
+    Each query goes to the replica with the lowest latency so far for the same method (exponentially weighted
+    moving average). If it takes longer than the 95th percentile of the latest latencies of the method,
+    the same query is sent to the next replica as well, and the first answer wins.
+    Failed queries are not latency samples: a replica is ranked after the ones with fewer consecutive failures.
+    Generator methods, streaming their results, are passed to the first replica as they are.
+    The group is closed, shutting down its threads, with close or at the end of a with block.
+    """
+    def __init__(self, *replicas: QueryHandler, alpha: float = 0.2, window: int = 200, min_samples: int = 20):
+        if not replicas:
+            raise ValueError('A replica group needs at least one handler.')
+        self.replicas: List[QueryHandler] = list(replicas)
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.window = window
+        # Per method: latency of each replica, never queried replicas coming first, and the latest latencies
+        self.latency: Dict[str, List[Optional[float]]] = {}
+        self.samples: Dict[str, deque[float]] = {}
+        self.failures: Dict[str, List[int]] = {}
+        self.hedged = 0
+        self._lock = Lock()
+        # Room for a primary and a hedge per replica, slow losers keep running in the background
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(replicas), thread_name_prefix='replica')
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.replicas[0], name)
+        if not callable(attr) or isgeneratorfunction(attr): # Only the time to create a generator could be measured
+            return attr
+        return partial(self._call, name)
+
+    def __enter__(self) -> 'ReplicaGroup':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Shuts down the threads of the group, without waiting for the hedged queries still running.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _ranked(self, name: str) -> List[int]:
+        with self._lock:
+            latency = self.latency.get(name, [None] * len(self.replicas))
+            failures = self.failures.get(name, [0] * len(self.replicas))
+            return sorted(range(len(self.replicas)), key=lambda i: (failures[i], latency[i] is not None, latency[i] or 0))
+
+    def _threshold(self, name: str) -> Optional[float]:
+        """
+        The 95th percentile of the latest latencies of a method, None until there are enough of them.
+        """
+        with self._lock:
+            if len(samples := self.samples.get(name, ())) < self.min_samples:
+                return None
+            samples = sorted(samples)
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def _record(self, name: str, position: int, latency: Optional[float]) -> None:
+        """
+        Records the latency of a successful query, or a failure with None.
+        """
+        with self._lock:
+            failures = self.failures.setdefault(name, [0] * len(self.replicas))
+            if latency is None:
+                failures[position] += 1
+                return
+            failures[position] = 0
+            averages = self.latency.setdefault(name, [None] * len(self.replicas))
+            previous = averages[position]
+            averages[position] = latency if previous is None else self.alpha * latency + (1 - self.alpha) * previous
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(latency)
+
+    def _timed(self, position: int, name: str, *args, **kwargs) -> Any:
+        method = getattr(self.replicas[position], name)
+        start = perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception: # A fast failure would otherwise rank the replica first
+            self._record(name, position, None)
+            raise
+        self._record(name, position, perf_counter() - start)
+        return result
+
+    def _submit(self, position: int, name: str, args: tuple, kwargs: dict) -> Future:
+        return self._executor.submit(self._timed, position, name, *args, **kwargs)
+
+    def _call(self, name: str, *args, **kwargs) -> Any:
+        order = self._ranked(name)
+        pending = {self._submit(order[0], name, args, kwargs)}
+        queued = order[1:]
+
+        done, _ = wait(pending, timeout=self._threshold(name))
+        if not done and queued: # Hedge a slow primary
+            with self._lock:
+                self.hedged += 1
+            pending.add(self._submit(queued.pop(0), name, args, kwargs))
+
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            # Every started query failed: try the next replica, or give up with the last error
+            if not pending:
+                if not queued:
+                    return future.result()
+                pending = {self._submit(queued.pop(0), name, args, kwargs)}
@@ -1,2 +1,5 @@
 from streamlod.mashups.basic_mashup import BasicMashup
-from streamlod.mashups.advanced_mashup import AdvancedMashup
\ No newline at end of file
+from streamlod.mashups.advanced_mashup import AdvancedMashup
+from streamlod.mashups.lazy import LazySequence
+from streamlod.mashups.batch import ObjectBatch, ActivityBatch
+from streamlod.mashups.materialized import MaterializedView
\ No newline at end of file
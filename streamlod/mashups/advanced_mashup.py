@@ -1,50 +1,170 @@
-from typing import List
+from typing import List, Iterable, Iterator, Callable, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import pandas as pd
 
 from streamlod.mashups.basic_mashup import BasicMashup
 from streamlod.entities import Person, CulturalHeritageObject, Activity
+from streamlod.utils import day_condition, coalesced
 
 class AdvancedMashup(BasicMashup):
     """
     The AdvancedMashup class manages two-way filter queries to multiple graph or relational databases
     and integrates the data into unified Python objects.
+
+    Two-way queries are semi-joins: the identifiers found on one side are sent to the other side
+    in batches of at most batch_size, each batch as soon as it is available.
+    When the handler statistics estimate that the identifiers are more than hashJoinRatio of the other side,
+    the other side is fetched whole and joined locally instead.
+    Each two-way query filters a single side, which is always evaluated first: starting from the other side
+    would fetch it whole, as the hash join does.
     """
-    def getActivitiesOnObjectsAuthoredBy(self, personId: str) -> List[Activity]:
-        object_ids = set()
+    hashJoinRatio = 0.5
+
+    def __init__(self, cache_size: int = 0, lazy: bool = False, batch_size: int = 1000, columnar: bool = False):
+        super().__init__(cache_size, lazy, columnar)
+        self.batchSize = batch_size
+        self.lastPlan: Optional[str] = None # Join chosen by the last two-way query
+
+    def _batches(self, identifiers: Iterable[str]) -> Iterator[List[str]]:
+        identifiers = list(identifiers)
+        for i in range(0, len(identifiers), self.batchSize):
+            yield identifiers[i:i + self.batchSize]
 
-        for handler in self.metadataQuery:
-            ids = handler.getEntities(select_only='identifier', by=('hasAuthor', 'identifier'), value=personId)
-            object_ids.update(ids)
+    def _semiJoin(
+        self,
+        batches: Iterable[List[str]],
+        handlers: List[Any],
+        routes: List[Any],
+        fetch: Callable[[Any, List[str]], pd.DataFrame]
+    ) -> List[pd.DataFrame]:
+        """
+        Pipelined semi-join: each batch of identifiers produced by the first phase is routed to the handlers
+        of the second phase and fetched in a thread pool while the next batch is being produced.
+        Identifiers already sent in a previous batch are skipped.
+        """
+        seen = set()
+        with ThreadPoolExecutor(max_workers=max(len(handlers), 1) * 2) as executor:
+            futures = []
+            for batch in batches:
+                batch = [identifier for identifier in dict.fromkeys(batch) if identifier not in seen]
+                seen.update(batch)
+                if batch:
+                    futures += [executor.submit(fetch, handler, ids) for handler, ids in self._route(handlers, routes, batch)]
+            return [future.result() for future in futures]
 
-        dfs = [handler.getById(object_ids) for handler in self.processQuery]
+    def _total(self, handlers: List[Any], statistic: Callable[[Any], Optional[int]]) -> Optional[int]:
+        """
+        Sums a statistic over the handlers, None if any of them has no statistics.
+        """
+        try:
+            values = [statistic(handler) for handler in handlers]
+        except Exception: # Handler without statistics or unreachable endpoint
+            return None
+        return None if not values or None in values else sum(values)
 
+    def _plan(self, matched: Optional[int], total: Optional[int]) -> str:
+        """
+        Chooses how to join an estimated number of matched identifiers with the other side holding total entities:
+        a semi-join sending the identifiers over, or a hash join fetching the other side whole and filtering locally
+        when the identifiers are a large part of it. Without statistics the semi-join is chosen.
+        """
+        if matched is not None and total is not None and matched > self.hashJoinRatio * total:
+            self.lastPlan = 'hash join'
+        else:
+            self.lastPlan = 'semi-join'
+        return self.lastPlan
+
+    def _distinctObjects(self, matched: Optional[int]) -> Optional[int]:
+        """
+        Estimates the distinct objects of an estimated number of matching activities, as if they were drawn
+        at random from the stored ones: objects * (1 - (1 - matched / activities) ** (activities / objects)).
+        """
+        activities = self._total(self.processQuery, lambda handler: handler.getStatistics()['activities'])
+        objects = self._total(self.processQuery, lambda handler: handler.getStatistics()['objects'])
+        if matched is None or activities is None or objects is None:
+            return None
+        elif not activities:
+            return 0
+        return round(objects * (1 - (1 - min(matched / activities, 1)) ** (activities / objects)))
+
+    @coalesced
+    def getActivitiesOnObjectsAuthoredBy(self, personId: str) -> List[Activity]:
+        authored = self._total(self.metadataQuery, lambda handler: handler.getStatistics()['hasAuthor'].get(personId, 0))
+        objects = self._total(self.processQuery, lambda handler: handler.getStatistics()['objects'])
+
+        batches = chain.from_iterable(
+            self._batches(handler.getEntities(select_only='identifier', by=('hasAuthor', 'identifier'), value=personId))
+            for handler, personId in self._route(self.metadataQuery, self.metadataRoutes, personId)
+        )
+        if self._plan(authored, objects) == 'hash join':
+            object_ids = set(chain.from_iterable(batches))
+            dfs = [df[df.refersTo.isin(object_ids)] for df in (handler.getAllActivities() for handler in self.processQuery)]
+        else:
+            dfs = self._semiJoin(batches, self.processQuery, self.processRoutes, lambda handler, ids: handler.getById(ids))
         return self.toActivity(dfs)
 
-    def getObjectsHandledByResponsiblePerson(self, partialName: str) -> List[CulturalHeritageObject]:
-        object_ids = set()
+    def _objectsOf(self, condition: Callable[[Any], str], matched: Optional[int]) -> List[pd.DataFrame]:
+        """
+        Joins the activities matching the condition with the objects they refer to, returning the object DataFrames.
+        The estimated number of matching activities is compared with the objects as the distinct objects they refer to.
+        """
+        objects = self._total(self.metadataQuery, lambda handler: handler.getStatistics()['objects'])
+        batches = chain.from_iterable(
+            handler.iterAttribute(condition=condition(handler), chunksize=self.batchSize) for handler in self.processQuery
+        )
+        if self._plan(self._distinctObjects(matched), objects) == 'hash join':
+            object_ids = set(chain.from_iterable(batches))
+            return [df[df.identifier.isin(object_ids)] for df in (handler.getAllCulturalHeritageObjects() for handler in self.metadataQuery)]
+        else:
+            return self._semiJoin(
+                batches, self.metadataQuery, self.metadataRoutes,
+                lambda handler, ids: handler.getEntities(by='identifier', value=ids)
+            )
 
-        for handler in self.processQuery:
-            ids = handler.getAttribute(condition=f"WHERE person LIKE '%{partialName}%'")
-            object_ids.update(ids)
-        
-        return self.getCulturalHeritageObjectsByIds(object_ids)
+    @coalesced
+    def getObjectsHandledByResponsiblePerson(self, partialName: str) -> List[CulturalHeritageObject]:
+        dfs = self._objectsOf(
+            lambda handler: f"WHERE {handler.likeCondition('A.person', partialName)}",
+            self._total(self.processQuery, lambda handler: handler.estimate('person', partialName))
+        )
+        return self.toCHO(dfs)
 
+    @coalesced
     def getObjectsHandledByResponsibleInstitution(self, partialName: str) -> List[CulturalHeritageObject]:
-        object_ids = set()
-
-        for handler in self.processQuery:
-            ids = handler.getAttribute(condition=f"WHERE institute LIKE '%{partialName}%'")
-            object_ids.update(ids)
+        dfs = self._objectsOf(
+            lambda handler: f"WHERE {handler.likeCondition('A.institute', partialName)}",
+            self._total(self.processQuery, lambda handler: handler.estimate('institute', partialName))
+        )
+        return self.toCHO(dfs)
 
-        return self.getCulturalHeritageObjectsByIds(object_ids)
-    
+    @coalesced
     def getAuthorsOfObjectsAcquiredInTimeFrame(self, start: str, end: str) -> List[Person]:
-        object_ids = set()
+        condition = lambda handler: (
+            f"WHERE {handler.likeCondition('A.class', 'Acquisition', partial=False)} AND "
+            f"{day_condition('A.start', start)} AND {day_condition('A.end', end, after=False)}"
+        )
+        # Acquisitions in the time frame, counted on the indexed days; without a count the semi-join is chosen.
+        # An object has at most one acquisition, so they count the distinct objects as well
+        acquisitions = self._total(self.processQuery, lambda handler: handler.countActivities(condition(handler)))
+        objects = self._total(self.metadataQuery, lambda handler: handler.getStatistics()['objects'])
 
-        for handler in self.processQuery:
-            ids = handler.getAttribute(
-                condition=f"WHERE class LIKE 'Acquisition' AND start >= '{start}' AND end <= '{end}'"
+        batches = chain.from_iterable(
+            handler.iterAttribute(condition=condition(handler), chunksize=self.batchSize) for handler in self.processQuery
+        )
+        if self._plan(acquisitions, objects) == 'hash join':
+            # Authors are taken from the author columns of the objects
+            object_ids = set(chain.from_iterable(batches))
+            dfs = [
+                df.loc[df.identifier.isin(object_ids), ['p_identifier', 'p_name']]
+                  .dropna()
+                  .set_axis(['identifier', 'name'], axis=1)
+                  .sort_values(by='name', ignore_index=True)
+                for df in (handler.getAllCulturalHeritageObjects() for handler in self.metadataQuery)
+            ]
+        else:
+            dfs = self._semiJoin(
+                batches, self.metadataQuery, self.metadataRoutes,
+                lambda handler, ids: handler.getAuthorsOfCulturalHeritageObject(ids)
             )
-            object_ids.update(ids)
-
-        dfs = [handler.getAuthorsOfCulturalHeritageObject(object_ids) for handler in self.metadataQuery]
         return self.toPerson(dfs)
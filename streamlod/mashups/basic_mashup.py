@@ -1,7 +1,11 @@
-from typing import Union, List, Set, Iterable
+from typing import Union, List, Set, Iterable, Optional, Container, Any, TypeVar, Sequence, Callable
+from collections import OrderedDict
+from threading import Lock
 import pandas as pd
+import numpy as np
 
 from streamlod.handlers import MetadataQueryHandler, ProcessDataQueryHandler
+from streamlod.handlers.base import UploadHandler
 from streamlod.entities.mappings import ACTIVITIES, ACQUISITION_ATTRIBUTES
 from streamlod.entities import (
     IdentifiableEntity,
@@ -10,35 +14,164 @@ from streamlod.entities import (
     Activity,
     Acquisition
 )
-from streamlod.utils import sorter
+from streamlod.mashups.lazy import LazySequence
+from streamlod.mashups.batch import ObjectBatch, ActivityBatch
+from streamlod.utils import sorter, coalesced, flight_key, SingleFlight, MissCache
 import streamlod.entities as entities
 
+Entity = TypeVar('Entity', bound=IdentifiableEntity)
+
 class BasicMashup:
     """
     The BasicMashup class manages one-sided filter queries to multiple graph or relational databases
     and integrates the data into unified Python objects.
+
+    With a cache_size, objects and people are kept in an identity map of at most that many entries
+    each: the same instances are returned as long as they are in the map, without being rebuilt.
+    Changes to the databases are seen only after invalidate.
+
+    A lazy mashup returns LazySequences instead of lists: the entities are built from
+    the integrated results only when accessed.
+
+    A columnar mashup returns objects and activities as an ObjectBatch or an ActivityBatch:
+    the integrated results are kept by column, read through row views or turned back into DataFrames,
+    without building the entities. People are returned as entities. Batches skip the identity map.
+
+    Once the mashup follows an upload handler, identifiers not found by getEntityById are remembered
+    for a short time in misses, and forgotten as soon as the handler pushes them.
     """
-    def __init__(self):
+    def __init__(self, cache_size: int = 0, lazy: bool = False, columnar: bool = False):
         self.metadataQuery = []
         self.processQuery = []
+        # Optional routes of the handlers, in the same order
+        self.metadataRoutes = []
+        self.processRoutes = []
+        # Identity maps, least recently used first
+        self.cacheSize = cache_size
+        self.objects: OrderedDict[str, CulturalHeritageObject] = OrderedDict()
+        self.people: OrderedDict[str, Person] = OrderedDict()
+        self._lock = Lock() # Guards the identity maps, shared by the threads of concurrent queries
+        self.lazy = lazy
+        self.columnar = columnar
+        self.misses = MissCache(size=0) # Enabled by follow
+        # Identical concurrent queries share one execution
+        self.flight = SingleFlight()
+
+    async def asyncQuery(self, methodName: str, *args, **kwargs) -> Any:
+        """
+        Runs a query method of the mashup from a coroutine, in a worker thread.
+        Waiting for an identical query already in flight, from a thread or another task, holds no thread.
+        """
+        method = getattr(type(self), methodName)
+        key = flight_key(methodName, args, kwargs)
+        return await self.flight.doAsync(key, getattr(method, '__wrapped__', method), self, *args, **kwargs)
+
+    def invalidate(self, identifiers: Optional[Iterable[str]] = None) -> bool:
+        """
+        Drops the given objects and people from the identity map, or all of them.
+        """
+        with self._lock:
+            if identifiers is None:
+                self.objects.clear()
+                self.people.clear()
+            else:
+                for identifier in identifiers:
+                    self.objects.pop(identifier, None)
+                    self.people.pop(identifier, None)
+        return True
+
+    def follow(self, handler: UploadHandler) -> bool:
+        """
+        Forgets the misses and the cached entities of the identifiers pushed by an upload handler of the sources,
+        and starts remembering the misses.
+        """
+        if not self.misses.size:
+            self.misses = MissCache()
+        return handler.addListener(self._pushed)
+
+    def _pushed(self, identifiers: List[str]) -> None:
+        self.misses.discard(identifiers)
+        self.invalidate(identifiers)
+
+    def _cached(self, store: OrderedDict[str, Entity], identifier: str) -> Optional[Entity]:
+        with self._lock:
+            if (entity := store.get(identifier)) is not None:
+                store.move_to_end(identifier)
+            return entity
+
+    def _remember(self, store: OrderedDict[str, Entity], entity: Entity) -> Entity:
+        """
+        Adds an entity to an identity map, or returns the instance another thread added in the meantime.
+        """
+        if not self.cacheSize:
+            return entity
+        with self._lock:
+            entity = store.setdefault(entity.identifier, entity)
+            store.move_to_end(entity.identifier)
+            if len(store) > self.cacheSize:
+                store.popitem(last=False)
+            return entity
+
+    def _person(self, identifier: str, name: str) -> Person:
+        return self._cached(self.people, identifier) or self._remember(self.people, Person(identifier, name))
 
     def cleanMetadataHandlers(self) -> bool:
         self.metadataQuery = []
+        self.metadataRoutes = []
+        self.invalidate()
+        self.misses.clear()
         return True
 
     def cleanProcessHandlers(self) -> bool:
         self.processQuery = []
+        self.processRoutes = []
         return True
 
-    def addMetadataHandler(self, handler: MetadataQueryHandler) -> bool:
+    def addMetadataHandler(self, handler: MetadataQueryHandler, route: Optional[Container[str]] = None) -> bool:
+        """
+        Registers a metadata query handler.
+        The optional route is the set of identifiers the handler can hold, such as the BloomFilter
+        built by the upload handler or a HashRoute: lookups by identifier skip the handler if it
+        cannot hold any of the requested identifiers.
+        Handlers over replicas of the same data are registered once, as a ReplicaGroup.
+        """
         self.metadataQuery.append(handler)
+        self.metadataRoutes.append(route)
+        self.invalidate() # Cached entities could miss the data of the new handler
+        self.misses.clear()
         return True
 
-    def addProcessHandler(self, handler: ProcessDataQueryHandler) -> bool:
+    def addProcessHandler(self, handler: ProcessDataQueryHandler, route: Optional[Container[str]] = None) -> bool:
+        """
+        Registers a process query handler, with an optional route as for metadata handlers.
+        """
         self.processQuery.append(handler)
+        self.processRoutes.append(route)
         return True
 
-    def _normalize(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]], entity_name: str) -> pd.DataFrame:
+    def _route(
+        self,
+        handlers: List[Any],
+        routes: List[Optional[Container[str]]],
+        identifiers: Union[str, Iterable[str]]
+    ) -> List[tuple[Any, Union[str, List[str]]]]:
+        """
+        Pairs each handler that can hold any of the identifiers with the identifiers it can hold.
+        Handlers registered without a route get all of them.
+        """
+        if isinstance(identifiers, str):
+            return [(handler, identifiers) for handler, route in zip(handlers, routes) if route is None or identifiers in route]
+
+        identifiers = list(identifiers)
+        result = []
+        for handler, route in zip(handlers, routes):
+            if route is None:
+                result.append((handler, identifiers))
+            elif (held := [identifier for identifier in identifiers if identifier in route]):
+                result.append((handler, held))
+        return result
+
+    def normalize(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]], entity_name: str) -> pd.DataFrame:
         """
         Normalizes input DataFrame or list of DataFrames.
 
@@ -67,17 +200,21 @@ class BasicMashup:
         adds missing data for authors or cultural objects.
         Removing duplicate identifiers from the dataframe without first performing this integration
         would result in the loss of this potentially valuable data.
+        Missing values are coalesced in one grouped pass, each entity taking the first value
+        defined for it in sort order.
         """
-        df = pd.concat(dfs)
+        df = pd.concat(dfs, ignore_index=True)
         match entity_name:
             case 'Person':
-                df = df.sort_values(by='name', ignore_index=True)
-                df.update(df.groupby('identifier').bfill())
+                df = df.sort_values(by='name', kind='stable', ignore_index=True)
+                df = df.groupby('identifier', sort=False, as_index=False).first()
             case 'CHO':
-                df = df.sort_values(by=['identifier', 'p_name'], key=sorter, ignore_index=True)
-                df.update(df.groupby('identifier').bfill())
+                df = df.sort_values(by=['identifier', 'p_name'], key=sorter, kind='stable', ignore_index=True)
+                # Object attributes are shared by all the rows of the object, the author pairs are not
+                attrs = df.columns.difference(['identifier', 'p_identifier', 'p_name'], sort=False)
+                df[attrs] = df.groupby('identifier', sort=False)[attrs].transform('first')
             case 'Activity':
-                df = df.sort_values(by=['refersTo', 'class'], key=sorter)
+                df = df.sort_values(by=['refersTo', 'class'], key=sorter, kind='stable')
 
         return df
 
@@ -99,78 +236,130 @@ class BasicMashup:
 
         return df
        
-    def toPerson(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]]) -> List[Person]:
+    def _sequence(
+        self,
+        rows: np.ndarray,
+        bounds: np.ndarray,
+        build: Callable[[np.ndarray], Entity],
+        keys: Optional[np.ndarray] = None
+    ) -> Sequence[Entity]:
+        """
+        Wraps the rows in a LazySequence, built at once into a list unless the mashup is lazy.
+        """
+        if self.lazy:
+            return LazySequence(rows, bounds, build, keys)
+        bounds = bounds.tolist()
+        return [build(rows[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+    def toPerson(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]]) -> Sequence[Person]:
         """
         Converts DataFrame(s) into a list of Person objects.
         """
-        df = self._normalize(dfs, 'Person')
+        df = self.normalize(dfs, 'Person')
         if df.empty:
             return []
 
         # Creates Person objects from DataFrame rows
-        return [Person(*row) for row in df.to_numpy(dtype=object, na_value=None)]
+        rows = df.to_numpy(dtype=object, na_value=None)
+        return self._sequence(rows, np.arange(len(rows) + 1), lambda rows: self._person(*rows[0]), rows[:, 0])
 
-    def toCHO(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]]) -> List[CulturalHeritageObject]:
+    def _buildCHO(self, rows: np.ndarray) -> CulturalHeritageObject:
+        """
+        Builds an object from its rows, one per author.
+        """
+        if (obj := self._cached(self.objects, rows[0][1])) is not None:
+            return obj # Already with its authors
+
+        # Authors, if present, are built with the object
+        authors = [self._person(*row[-2:]) for row in rows if row[-2]]
+        return self._remember(self.objects, rows[0][0](*rows[0][1:-2], authors))
+
+    def toCHO(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]]) -> Sequence[CulturalHeritageObject]:
         """
         Converts DataFrame(s) into a list of CulturalHeritageObjects.
         """
-        df = self._normalize(dfs, 'CHO')
+        df = self.normalize(dfs, 'CHO')
+        if self.columnar:
+            return self._objectBatch(df)
         if df.empty:
             return []
 
-        result: List[CulturalHeritageObject] = []
-        object_id = '' # Variable to track the current object identifier
-
         # Convert object class name to class reference
         classes = {obj: getattr(entities, obj) for obj in df['class'].unique()}
         df.loc[:,'class'] = df['class'].map(classes)
 
-        for row in df.to_numpy(dtype=object, na_value=None):
-            # Create a new object if the identifier is different from the previous row
-            if object_id != row[1]:
-                object_id = row[1]
-                result.append(row[0](*row[1:-2]))
-            # Append author to the hasAuthor list if present
-            if row[-2]:
-                result[-1].hasAuthor.append(Person(*row[-2:]))
+        # A new object starts where the identifier differs from the previous row
+        rows = df.to_numpy(dtype=object, na_value=None)
+        starts = np.flatnonzero(df['identifier'].ne(df['identifier'].shift()).to_numpy())
+        return self._sequence(rows, np.append(starts, len(rows)), self._buildCHO, rows[starts, 1])
 
-        return result
+    def _objectBatch(self, df: pd.DataFrame) -> ObjectBatch:
+        """
+        Splits the integrated rows, one per object and author, into the objects and their authors.
+        """
+        if df.empty:
+            return ObjectBatch(df)
+        first = df['identifier'].ne(df['identifier'].shift()).to_numpy()
+        authors = df.loc[df['p_identifier'].notna(), ['identifier', 'p_identifier', 'p_name']]
+        return ObjectBatch(df[first], authors)
+
+    def _activityBatch(self, df: pd.DataFrame) -> ActivityBatch:
+        """
+        Keeps the activities on objects found by the metadata handlers, with the batch of those objects.
+        """
+        if df.empty:
+            return ActivityBatch(df)
+        objects = self.getCulturalHeritageObjectsByIds(df['refersTo'].unique())
+        return ActivityBatch(df[df['refersTo'].isin(objects['identifier'])], objects)
 
-    def toActivity(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]]) -> List[Activity]:
+    def toActivity(self, dfs: Union[pd.DataFrame, List[pd.DataFrame]]) -> Sequence[Activity]:
         """
         Converts DataFrame(s) into a list of Activity objects.
         """
-        df = self._normalize(dfs, 'Activity')
+        df = self.normalize(dfs, 'Activity')
+        if self.columnar:
+            return self._activityBatch(df)
         if df.empty:
             return []
 
-        result: List[Activity] = []
-
-        # Make sure all objects the activities refer to are present in the database
-        objects = self.getCulturalHeritageObjectsByIds(df.refersTo.unique())
-        object_ids = set(obj.identifier for obj in objects)
-        df = df[df.refersTo.isin(object_ids)]
-
-        # Convert object reference to position in object list
-        df.refersTo = df.refersTo.factorize()[0]
+        # Make sure all objects the activities refer to are present in the database,
+        # fetching only those not in the identity map
+        objects = {}
+        missing = []
+        for identifier in df.refersTo.unique():
+            if (obj := self._cached(self.objects, identifier)) is not None:
+                objects[identifier] = obj
+            else:
+                missing.append(identifier)
+        fetched = self.getCulturalHeritageObjectsByIds(missing) if missing else []
+        # Fetched objects are looked up by position, so that lazy ones are built only when needed
+        keys = fetched.keys if isinstance(fetched, LazySequence) else [obj.identifier for obj in fetched]
+        positions = dict(zip(keys, range(len(keys))))
+        df = df[df.refersTo.isin(objects.keys() | positions.keys())]
 
         # Convert activity class name to class reference
         classes = {activity: getattr(entities, activity) for activity in df['class'].unique()}
         df.loc[:,'class'] = df['class'].map(classes)
 
-        # Iterate through the DataFrame rows, creating activity instances and linking them with cultural heritage objects
-        for row in df.to_numpy(dtype=object, na_value=None):
-            obj = objects[row[1]]
+        # Create activity instances linked with cultural heritage objects
+        def build(rows: np.ndarray) -> Activity:
+            row = rows[0]
+            obj = objects[row[1]] if row[1] in objects else fetched[positions[row[1]]]
             if row[0] is Acquisition:
-                result.append(Acquisition(obj, *row[2:]))
+                return Acquisition(obj, *row[2:])
             else:
-                result.append(row[0](obj, *row[3:]))
+                return row[0](obj, *row[3:])
 
-        return result
+        rows = df.to_numpy(dtype=object, na_value=None)
+        return self._sequence(rows, np.arange(len(rows) + 1), build)
 
+    @coalesced
     def getEntityById(self, identifier: str) -> Union[IdentifiableEntity, None]:
+        if identifier in self.misses:
+            return None
+
         obj_dfs, people_dfs = [], []
-        for handler in self.metadataQuery:
+        for handler, identifier in self._route(self.metadataQuery, self.metadataRoutes, identifier):
             df = handler.getById(identifier)
             if df.empty:
                 continue
@@ -185,57 +374,73 @@ class BasicMashup:
         elif people_dfs:
             result = self.toPerson(people_dfs)
         else:
+            self.misses.add(identifier)
             return None
 
         return result[0] if result else None # Check result again as constructors might return an empty list for invalid data
 
+    @coalesced
     def getCulturalHeritageObjectsByIds(self, identifiers: Iterable[str]) -> List[CulturalHeritageObject]:
         """
         Retrieves cultural heritage objects by their identifiers from multiple metadata handlers.
         """
-        dfs = [handler.getEntities(by='identifier', value=set(identifiers)) for handler in self.metadataQuery]
+        routed = self._route(self.metadataQuery, self.metadataRoutes, set(identifiers))
+        dfs = [handler.getEntities(by='identifier', value=ids) for handler, ids in routed]
         return self.toCHO(dfs)
 
+    @coalesced
     def getAllPeople(self) -> List[Person]:
         dfs = [handler.getAllPeople() for handler in self.metadataQuery]
         return self.toPerson(dfs)
 
+    @coalesced
     def getAllCulturalHeritageObjects(self) -> List[CulturalHeritageObject]:
         dfs = [handler.getAllCulturalHeritageObjects() for handler in self.metadataQuery]
         return self.toCHO(dfs)
 
+    @coalesced
     def getAuthorsOfCulturalHeritageObject(self, objectId: str) -> List[Person]:
-        dfs = [handler.getAuthorsOfCulturalHeritageObject(objectId) for handler in self.metadataQuery]
+        routed = self._route(self.metadataQuery, self.metadataRoutes, objectId)
+        dfs = [handler.getAuthorsOfCulturalHeritageObject(objectId) for handler, objectId in routed]
         return self.toPerson(dfs)
 
+    @coalesced
     def getCulturalHeritageObjectsAuthoredBy(self, personId: str) -> List[CulturalHeritageObject]:
-        dfs = [handler.getCulturalHeritageObjectsAuthoredBy(personId) for handler in self.metadataQuery]
+        routed = self._route(self.metadataQuery, self.metadataRoutes, personId)
+        dfs = [handler.getCulturalHeritageObjectsAuthoredBy(personId) for handler, personId in routed]
         return self.toCHO(dfs)
 
+    @coalesced
     def getAllActivities(self) -> List[Activity]:
         dfs = [handler.getAllActivities() for handler in self.processQuery]
         return self.toActivity(dfs)
 
+    @coalesced
     def getActivitiesByResponsibleInstitution(self, partialName: str) -> List[Activity]:
         dfs = [handler.getActivitiesByResponsibleInstitution(partialName) for handler in self.processQuery]
         return self.toActivity(dfs)
 
+    @coalesced
     def getActivitiesByResponsiblePerson(self, partialName: str) -> List[Activity]:
         dfs = [handler.getActivitiesByResponsiblePerson(partialName) for handler in self.processQuery]
         return self.toActivity(dfs)
 
+    @coalesced
     def getActivitiesUsingTool(self, partialName: str) -> List[Activity]:
         dfs = [handler.getActivitiesUsingTool(partialName) for handler in self.processQuery]
         return self.toActivity(dfs)
 
+    @coalesced
     def getActivitiesStartedAfter(self, date: str) -> List[Activity]:
         dfs = [handler.getActivitiesStartedAfter(date) for handler in self.processQuery]
         return self.toActivity(dfs)
 
+    @coalesced
     def getActivitiesEndedBefore(self, date:str) -> List[Activity]:
         dfs = [handler.getActivitiesEndedBefore(date) for handler in self.processQuery]
         return self.toActivity(dfs)
 
+    @coalesced
     def getAcquisitionsByTechnique(self, partialName: str) -> List[Activity]:
         dfs = [handler.getAcquisitionsByTechnique(partialName) for handler in self.processQuery]
         return self.toActivity(dfs)
\ No newline at end of file
@@ -0,0 +1,253 @@
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Union
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError: # Arrow output is optional
+    pa = None
+
+import streamlod.entities as entities
+from streamlod.entities import Person, CulturalHeritageObject, Activity, Acquisition
+
+Index = Union[int, str, slice, np.ndarray, pd.Series, List[Any]]
+
+class EntityBatch(Sequence):
+    """
+    A read-only sequence of entities stored by column in a DataFrame, one row per entity.
+
+    Indexing by an attribute name returns the array of its values, by position a row view
+    acting like the entity, by slice, boolean mask or positions a filtered batch.
+    No entity is built unless asked with toEntity.
+    """
+    columns: tuple[str, ...] = ()
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame.reindex(columns=list(self.columns)).reset_index(drop=True)
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def __getitem__(self, index: Index) -> Any:
+        if isinstance(index, str):
+            if (array := self._arrays.get(index)) is None:
+                array = self._arrays[index] = self.frame[index].to_numpy(dtype=object, na_value=None)
+            return array
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f'{self.__class__.__name__} index out of range')
+            return self._view(int(index))
+        return self.filter(index)
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(len(self)):
+            yield self._view(i)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(x == y for x, y in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(len={len(self)})'
+
+    @abstractmethod
+    def _view(self, position: int) -> Any:
+        """
+        Returns the row view of the entity at a position.
+        """
+
+    def _subset(self, frame: pd.DataFrame) -> 'EntityBatch':
+        return self.__class__(frame)
+
+    def filter(self, mask: Union[slice, np.ndarray, pd.Series, List[Any]]) -> 'EntityBatch':
+        """
+        Returns the batch of the entities selected by a slice, a boolean mask or their positions.
+        """
+        if isinstance(mask, slice):
+            return self._subset(self.frame.iloc[mask])
+        mask = np.asarray(mask)
+        return self._subset(self.frame[mask] if mask.dtype == bool else self.frame.iloc[mask])
+
+    def to_pandas(self) -> pd.DataFrame:
+        return self.frame.copy()
+
+    def to_arrow(self) -> 'pa.Table':
+        if pa is None:
+            raise ImportError('Arrow output requires pyarrow.')
+        return pa.Table.from_pandas(self.to_pandas(), preserve_index=False)
+
+
+class ObjectBatch(EntityBatch):
+    """
+    Cultural heritage objects by column, with their authors in a second DataFrame of
+    the object identifier and the author identifier and name, one row per author.
+    """
+    columns = ('class', 'identifier', 'title', 'owner', 'place', 'date')
+
+    def __init__(self, frame: pd.DataFrame, authors: Optional[pd.DataFrame] = None):
+        super().__init__(frame)
+        if authors is None:
+            authors = pd.DataFrame(columns=['identifier', 'p_identifier', 'p_name'])
+        self.authors = authors.reset_index(drop=True)
+        self._index: Optional[pd.Index] = None
+        self._people: Optional[Dict[str, List[Person]]] = None
+
+    def _view(self, position: int) -> 'ObjectView':
+        return ObjectView(self, position)
+
+    def _subset(self, frame: pd.DataFrame) -> 'ObjectBatch':
+        return ObjectBatch(frame, self.authors[self.authors.identifier.isin(frame.identifier)])
+
+    def positions(self, identifiers: Any) -> np.ndarray:
+        """
+        Returns the position of each identifier in the batch, -1 if missing.
+        """
+        if self._index is None:
+            self._index = pd.Index(self['identifier'])
+        return self._index.get_indexer(identifiers)
+
+    def people(self, identifier: str) -> List[Person]:
+        """
+        Returns the authors of an object, built on first use for the whole batch.
+        """
+        if self._people is None:
+            self._people = {}
+            for objectId, personId, name in self.authors.itertuples(index=False):
+                self._people.setdefault(objectId, []).append(Person(personId, name))
+        return self._people.get(identifier, [])
+
+
+class ActivityBatch(EntityBatch):
+    """
+    Activities by column, with the ObjectBatch of the objects they refer to.
+    Tools are kept as sets and written to Arrow as sorted lists.
+    """
+    columns = ('class', 'refersTo', 'technique', 'institute', 'person', 'start', 'end', 'tool')
+
+    def __init__(self, frame: pd.DataFrame, objects: Optional[ObjectBatch] = None):
+        super().__init__(frame)
+        self.objects = ObjectBatch(pd.DataFrame()) if objects is None else objects
+
+    def _view(self, position: int) -> 'ActivityView':
+        return ActivityView(self, position)
+
+    def _subset(self, frame: pd.DataFrame) -> 'ActivityBatch':
+        return ActivityBatch(frame, self.objects)
+
+    def to_arrow(self) -> 'pa.Table':
+        if pa is None:
+            raise ImportError('Arrow output requires pyarrow.')
+        df = self.to_pandas()
+        df['tool'] = df['tool'].map(sorted, na_action='ignore')
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+class RowView(ABC):
+    """
+    A row of a batch, read through the getters of the entity it stands for.
+    Views equal and hash as the entity built by toEntity.
+    """
+    __slots__ = ('batch', 'position')
+
+    def __init__(self, batch: EntityBatch, position: int):
+        self.batch = batch
+        self.position = position
+
+    def __getattr__(self, name: str) -> Any:
+        if name in self.batch.columns:
+            return self.batch[name][self.position]
+        raise AttributeError(f'{self.__class__.__name__!r} object has no attribute {name!r}')
+
+    def _class(self) -> str:
+        return self.batch['class'][self.position]
+
+    @abstractmethod
+    def toEntity(self) -> Any:
+        """
+        Builds the entity the row stands for.
+        """
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, RowView):
+            other = other.toEntity()
+        return self.toEntity() == other
+
+    def __hash__(self):
+        return hash(self.toEntity())
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.toEntity()!r})'
+
+
+class ObjectView(RowView):
+    __slots__ = ()
+
+    def getId(self) -> str:
+        return self.identifier
+
+    def getTitle(self) -> str:
+        return self.title
+
+    def getDate(self) -> Union[str, None]:
+        return self.date
+
+    def getOwner(self) -> str:
+        return self.owner
+
+    def getPlace(self) -> str:
+        return self.place
+
+    def getAuthors(self) -> List[Person]:
+        return self.batch.people(self.identifier)
+
+    @property
+    def hasAuthor(self) -> List[Person]:
+        return self.getAuthors()
+
+    def toEntity(self) -> CulturalHeritageObject:
+        return getattr(entities, self._class())(self.identifier, self.title, self.owner, self.place, self.date, list(self.getAuthors()))
+
+
+class ActivityView(RowView):
+    __slots__ = ()
+
+    def getResponsibleInstitute(self) -> str:
+        return self.institute
+
+    def getResponsiblePerson(self) -> Union[str, None]:
+        return self.person
+
+    def getTools(self) -> Set[str]:
+        return set() if self.tool is None else self.tool
+
+    def getStartDate(self) -> Union[str, None]:
+        return self.start
+
+    def getEndDate(self) -> Union[str, None]:
+        return self.end
+
+    def getTechnique(self) -> str:
+        if self._class() != 'Acquisition':
+            raise AttributeError(f'{self._class()!r} activity has no technique')
+        return self.technique
+
+    def refersTo(self) -> Optional[ObjectView]:
+        objects = self.batch.objects
+        position = int(objects.positions([self.batch['refersTo'][self.position]])[0])
+        return None if position < 0 else objects[position]
+
+    @property
+    def object(self) -> Optional[ObjectView]:
+        return self.refersTo()
+
+    def toEntity(self) -> Activity:
+        name = self._class()
+        obj = self.refersTo().toEntity()
+        if name == 'Acquisition':
+            return Acquisition(obj, self.technique, self.institute, self.person, self.start, self.end, self.tool)
+        return getattr(entities, name)(obj, self.institute, self.person, self.start, self.end, self.tool)
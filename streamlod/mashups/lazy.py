@@ -0,0 +1,57 @@
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Union, overload
+import numpy as np
+
+class LazySequence(Sequence):
+    """
+    A read-only sequence of entities backed by the rows of an integrated DataFrame.
+
+    Element i is built from the rows bounds[i]:bounds[i + 1] the first time it is accessed,
+    and cached from then on. Slices return lists of the built elements.
+    The optional keys hold the identifier of each element, known without building it.
+    """
+    def __init__(
+        self,
+        rows: np.ndarray,
+        bounds: np.ndarray,
+        build: Callable[[np.ndarray], Any],
+        keys: Optional[np.ndarray] = None
+    ):
+        self.rows = rows
+        self.bounds = bounds
+        self.build = build
+        self.keys = keys
+        self._built: List[Any] = [None] * (len(bounds) - 1)
+
+    def __len__(self) -> int:
+        return len(self._built)
+
+    @overload
+    def __getitem__(self, index: int) -> Any: ...
+    @overload
+    def __getitem__(self, index: slice) -> List[Any]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Any, List[Any]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('LazySequence index out of range')
+
+        if (element := self._built[index]) is None:
+            element = self._built[index] = self.build(self.rows[self.bounds[index]:self.bounds[index + 1]])
+        return element
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(x == y for x, y in zip(self, other))
+
+    def __repr__(self) -> str:
+        built = sum(element is not None for element in self._built)
+        return f'LazySequence(len={len(self)}, built={built})'
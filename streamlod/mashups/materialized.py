@@ -0,0 +1,263 @@
+from typing import Union, List, Dict, Set, Iterable, Optional, Any
+from threading import Lock, Event, Thread
+from contextlib import closing
+from time import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from streamlod.handlers import ProcessDataUploadHandler, ProcessDataQueryHandler
+from streamlod.handlers.base import UploadHandler, QueryHandler
+from streamlod.mashups.basic_mashup import BasicMashup
+from streamlod.mashups.advanced_mashup import AdvancedMashup
+from streamlod.utils import id_rank
+
+class MaterializedMetadataQueryHandler(QueryHandler):
+    """
+    Answers the metadata queries of the mashups from the object, person and author tables
+    of a materialized view, with the same DataFrames as MetadataQueryHandler.
+    """
+    _objects = """
+        SELECT O.class, O.identifier, O.title, O.owner, O.place, O.date, A.personId AS p_identifier, A.name AS p_name
+        FROM Object AS O LEFT JOIN Author AS A ON A.objectId = O.identifier
+        {}
+        ORDER BY O.idRank, O.identifier, A.name;"""
+    _people = """
+        SELECT P.identifier, P.name
+        FROM Person AS P
+        {}
+        ORDER BY P.name;"""
+    # Filters on the temporary table of the requested identifiers per entity and relation
+    _filters = {
+        ('CHO', 'identifier'): 'WHERE O.identifier IN temp.Ids',
+        ('CHO', ('hasAuthor', 'identifier')): 'WHERE O.identifier IN (SELECT objectId FROM Author WHERE personId IN temp.Ids)',
+        ('Person', 'identifier'): 'WHERE P.identifier IN temp.Ids',
+        ('Person', ('CHO', 'hasAuthor', 'identifier')): 'WHERE P.identifier IN (SELECT personId FROM Author WHERE objectId IN temp.Ids)'
+    }
+
+    def getEntities(
+        self,
+        entityName: str = 'CHO',
+        select_only: Optional[str] = None,
+        by: Optional[Union[str, tuple[str, ...]]] = None,
+        value: Any = None
+    ) -> Union[pd.DataFrame, np.ndarray]:
+        query = self._objects if entityName == 'CHO' else self._people
+        with closing(sqlite3.connect(self.getDbPathOrUrl())) as con:
+            if by and value is not None:
+                con.execute("CREATE TEMP TABLE Ids (id TEXT PRIMARY KEY) WITHOUT ROWID;")
+                values = [value] if isinstance(value, str) else value
+                con.executemany("INSERT OR IGNORE INTO temp.Ids VALUES (?);", ((identifier,) for identifier in values))
+                query = query.format(self._filters[entityName, by])
+            else:
+                query = query.format('')
+            df = pd.read_sql_query(query, con, dtype='object')
+
+        if select_only:
+            return df[select_only].drop_duplicates().to_numpy()
+        return df
+
+    def getById(self, identifier: Union[str, Iterable[str]]) -> pd.DataFrame:
+        df = self.getEntities(by='identifier', value=identifier)
+        if df.empty:
+            df = self.getEntities('Person', by='identifier', value=identifier)
+        return df
+
+    def getAllPeople(self) -> pd.DataFrame:
+        return self.getEntities('Person')
+
+    def getAllCulturalHeritageObjects(self) -> pd.DataFrame:
+        return self.getEntities()
+
+    def getAuthorsOfCulturalHeritageObject(self, objectId: Union[str, Iterable[str]]) -> pd.DataFrame:
+        return self.getEntities('Person', by=('CHO', 'hasAuthor', 'identifier'), value=objectId)
+
+    def getCulturalHeritageObjectsAuthoredBy(self, personId: Union[str, Iterable[str]]) -> pd.DataFrame:
+        return self.getEntities(by=('hasAuthor', 'identifier'), value=personId)
+
+    def getStatistics(self) -> Dict[str, Any]:
+        with closing(sqlite3.connect(self.getDbPathOrUrl())) as con:
+            return {
+                'objects': con.execute("SELECT COUNT(*) FROM Object;").fetchone()[0],
+                'people': con.execute("SELECT COUNT(*) FROM Person;").fetchone()[0],
+                'hasAuthor': dict(con.execute("SELECT personId, COUNT(*) FROM Author GROUP BY personId;").fetchall())
+            }
+
+
+class MaterializedView:
+    """
+    A local snapshot of the objects, people, authorships and activities of a mashup
+    in one indexed SQLite database, answering the mashup queries without reaching the sources.
+
+    Activities are stored in the schema of the process databases, objects, people and authors in three more tables.
+    The view is refreshed in full by refresh(), on a schedule, or incrementally: listening to upload handlers,
+    the identifiers of each push are refreshed as soon as it succeeds.
+    """
+    def __init__(self, path: str, source: BasicMashup, *, reset: bool = False):
+        self.path = path
+        self.source = source
+        self.pending: Set[str] = set() # Pushed identifiers not refreshed yet
+        self._lock = Lock()
+        self._stop: Optional[Event] = None
+
+        # The activity tables of a plain process database
+        self._process = ProcessDataUploadHandler()
+        self._process.setDbPathOrUrl(path, reset=reset)
+        with sqlite3.connect(path) as con:
+            if reset:
+                for table in ('Object', 'Person', 'Author', 'Refresh'):
+                    con.execute(f"DROP TABLE IF EXISTS {table};")
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS Object (
+                    identifier TEXT PRIMARY KEY,
+                    class TEXT NOT NULL,
+                    title TEXT,
+                    owner TEXT,
+                    place TEXT,
+                    date TEXT,
+                    idRank INTEGER NOT NULL
+                );
+            """)
+            con.execute("CREATE INDEX IF NOT EXISTS ObjectOrder ON Object (idRank, identifier);")
+            con.execute("CREATE TABLE IF NOT EXISTS Person (identifier TEXT PRIMARY KEY, name TEXT);")
+            con.execute("CREATE TABLE IF NOT EXISTS Author (objectId TEXT NOT NULL, personId TEXT NOT NULL, name TEXT);")
+            con.execute("CREATE INDEX IF NOT EXISTS AuthorObject ON Author (objectId);")
+            con.execute("CREATE INDEX IF NOT EXISTS AuthorPerson ON Author (personId);")
+            con.execute("CREATE TABLE IF NOT EXISTS Refresh (refreshed REAL NOT NULL);")
+
+    def listen(self, handler: UploadHandler, auto: bool = True) -> bool:
+        """
+        Follows the pushes of an upload handler of the sources. With auto, the pushed identifiers
+        are refreshed right away, otherwise they are kept pending until the next refresh.
+        """
+        return handler.addListener(self._pushed if auto else self.pending.update)
+
+    def _pushed(self, identifiers: List[str]) -> None:
+        self.pending.update(identifiers)
+        self.refresh(incremental=True)
+
+    def refresh(self, incremental: bool = False) -> bool:
+        """
+        Snapshots the sources again: all of them, or with incremental only the pending identifiers.
+        """
+        with self._lock:
+            identifiers = list(self.pending)
+            if incremental and not identifiers:
+                return True
+            source = self.source
+            try:
+                if incremental:
+                    objects = [handler.getEntities(by='identifier', value=identifiers) for handler in source.metadataQuery]
+                    people = [handler.getEntities('Person', by='identifier', value=identifiers) for handler in source.metadataQuery]
+                    activities = [handler.getById(identifiers) for handler in source.processQuery]
+                else:
+                    objects = [handler.getAllCulturalHeritageObjects() for handler in source.metadataQuery]
+                    people = [handler.getAllPeople() for handler in source.metadataQuery]
+                    activities = [handler.getAllActivities() for handler in source.processQuery]
+            except Exception as e: # Unreachable source: the view stays as it is
+                print(e)
+                return False
+
+            try:
+                with closing(sqlite3.connect(self.path)) as con, con:
+                    if incremental:
+                        con.execute("CREATE TEMP TABLE Ids (id TEXT PRIMARY KEY) WITHOUT ROWID;")
+                        con.executemany("INSERT OR IGNORE INTO temp.Ids VALUES (?);", ((identifier,) for identifier in identifiers))
+                        where = 'WHERE {} IN temp.Ids'
+                        removed = self._activities(con, where.format('A.refersTo'))
+                    else:
+                        where = ''
+                        removed = None
+                        con.execute("DELETE FROM Statistic;") # Recomputed on insert
+                    con.execute(f"DELETE FROM Object {where.format('identifier')};")
+                    con.execute(f"DELETE FROM Author {where.format('objectId')};")
+                    con.execute(f"DELETE FROM Person {where.format('identifier')};")
+                    con.execute(f"DELETE FROM Tool WHERE activityId IN (SELECT internalId FROM Activity {where.format('refersTo')});")
+                    con.execute(f"DELETE FROM Activity {where.format('refersTo')};")
+                    if removed is not None and not removed.empty:
+                        self._process.discountActivities(con, removed)
+
+                    self._insertObjects(con, source.normalize(objects, 'CHO'))
+                    self._insertPeople(con, source.normalize(people, 'Person'))
+                    self._insertActivities(con, source.normalize(activities, 'Activity'))
+                    con.execute("DELETE FROM Refresh;")
+                    con.execute("INSERT INTO Refresh VALUES (?);", (time(),))
+            except sqlite3.Error as e: # Rolled back: the view stays as it is, and the identifiers pending
+                print(e)
+                return False
+
+            self.pending.difference_update(identifiers)
+            return True
+
+    def _insertObjects(self, con: sqlite3.Connection, df: pd.DataFrame) -> None:
+        if df.empty:
+            return
+        rows = df.drop_duplicates('identifier')
+        rows = rows.assign(idRank=rows['identifier'].map(id_rank))
+        con.executemany(
+            "INSERT OR REPLACE INTO Object VALUES (?, ?, ?, ?, ?, ?, ?);",
+            rows[['identifier', 'class', 'title', 'owner', 'place', 'date', 'idRank']].to_numpy(dtype=object, na_value=None)
+        )
+        authors = df[['identifier', 'p_identifier', 'p_name']].dropna()
+        con.executemany("INSERT INTO Author VALUES (?, ?, ?);", authors.to_numpy(dtype=object))
+
+    def _insertPeople(self, con: sqlite3.Connection, df: pd.DataFrame) -> None:
+        if not df.empty:
+            con.executemany("INSERT OR REPLACE INTO Person VALUES (?, ?);", df[['identifier', 'name']].to_numpy(dtype=object, na_value=None))
+
+    def _insertActivities(self, con: sqlite3.Connection, df: pd.DataFrame) -> None:
+        if not df.empty:
+            df = df[['class', 'refersTo', 'technique', 'institute', 'person', 'start', 'end', 'tool']].copy()
+            df['tool'] = df['tool'].map(sorted, na_action='ignore')
+            self._process.insertActivities(con, df)
+
+    def _activities(self, con: sqlite3.Connection, where: str) -> pd.DataFrame:
+        """
+        Returns the stored activities matching the condition with the lists of their tools, to update the statistics.
+        """
+        df = pd.read_sql_query(f"SELECT internalId, class, refersTo, technique, institute, person FROM Activity AS A {where};", con)
+        tools = pd.read_sql_query(f"SELECT T.activityId, T.tool FROM Tool AS T JOIN Activity AS A ON A.internalId = T.activityId {where};", con)
+        return df.join(tools.groupby('activityId')['tool'].agg(list), on='internalId')
+
+    def getStaleness(self) -> Optional[float]:
+        """
+        Returns the seconds elapsed since the last refresh, None if the view was never refreshed.
+        Identifiers pushed in the meantime and not refreshed yet are listed in pending.
+        """
+        with closing(sqlite3.connect(self.path)) as con:
+            row = con.execute("SELECT refreshed FROM Refresh;").fetchone()
+        return None if row is None else time() - row[0]
+
+    def schedule(self, interval: float) -> bool:
+        """
+        Refreshes the whole view every interval seconds in a background thread, until stop.
+        """
+        self.stop()
+        self._stop = stop = Event()
+
+        def run() -> None:
+            while not stop.wait(interval):
+                self.refresh()
+
+        Thread(target=run, name='view-refresh', daemon=True).start()
+        return True
+
+    def stop(self) -> bool:
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        return True
+
+    def toMashup(self, **options: Any) -> AdvancedMashup:
+        """
+        Returns a mashup answering from the view only, built with the given AdvancedMashup options.
+        """
+        metadata = MaterializedMetadataQueryHandler()
+        metadata.setDbPathOrUrl(self.path)
+        process = ProcessDataQueryHandler()
+        process.setDbPathOrUrl(self.path)
+
+        mashup = AdvancedMashup(**options)
+        mashup.addMetadataHandler(metadata)
+        mashup.addProcessHandler(process)
+        return mashup
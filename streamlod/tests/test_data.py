@@ -214,8 +214,9 @@ class Test_02_DuplicateData(unittest.TestCase):
 
         for p in p1:
             self.assertEqual(p1[0], p)
-        
-        self.assertEqual(len(p1), 60)
+
+        # Duplicate activities are stored only once
+        self.assertEqual(len(p1), 1)
 
 
 if __name__ == '__main__':
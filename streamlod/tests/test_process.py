@@ -0,0 +1,977 @@
+"""
+Tests of the relational side only, they do not need the Blazegraph database
+
+    python -m unittest -v streamlod/tests/test_process.py
+"""
+import unittest
+from os import sep
+import json
+import sqlite3
+from tempfile import TemporaryDirectory
+from contextlib import closing
+from unittest import mock
+import gzip
+import pandas as pd
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from itertools import chain
+from typing import Generator
+from urllib.parse import quote_plus
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet is optional
+    pa = pq = None
+
+from streamlod.handlers import ProcessDataUploadHandler, ProcessDataQueryHandler, MetadataUploadHandler, MetadataQueryHandler, ReplicaGroup
+from streamlod.handlers.process import _shard_paths
+from streamlod.mashups import AdvancedMashup, LazySequence, MaterializedView, ObjectBatch, ActivityBatch
+from streamlod.mashups.batch import EntityBatch, RowView
+from streamlod.entities import Person, Painting, Acquisition
+from streamlod.entities.mappings import IDE, BASE, Relation
+from streamlod.utils import key, sorter, id_rank, HashRoute, BloomFilter
+
+def stored_statistics(db: str, recompute: bool = False) -> list:
+    """
+    The statistics stored in a database, or recomputed from its tables in a transaction rolled back afterwards.
+    """
+    with closing(sqlite3.connect(db)) as con:
+        if recompute:
+            ProcessDataUploadHandler()._analyze(con)
+        rows = con.execute("SELECT attribute, value, count FROM Statistic ORDER BY attribute, value;").fetchall()
+        con.rollback()
+    return rows
+
+# Columns of the object DataFrames of the metadata handlers, one row per author
+COLUMNS = ['class', 'identifier', 'title', 'owner', 'place', 'date', 'p_identifier', 'p_name']
+
+def fake_objects(identifiers: list, authors: int = 0) -> pd.DataFrame:
+    """
+    Paintings of the given identifiers, authored by one of as many people, or each by its own with no count.
+    """
+    rows = []
+    for identifier in identifiers:
+        author = int(identifier) % authors if authors else identifier
+        rows.append(['Painting', str(identifier), f'Title {identifier}', 'Owner', 'Place', None, f'VIAF:{author}', f'Name {author}'])
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+class FakeMetadata:
+    """
+    Metadata query handler answering from a DataFrame of objects, with a given number of objects in its statistics.
+    """
+    def __init__(self, objects: pd.DataFrame, total: int = None):
+        self.objects = objects
+        self.people = (
+            objects[['p_identifier', 'p_name']].dropna().drop_duplicates()
+            .set_axis(['identifier', 'name'], axis=1).sort_values(by='name', ignore_index=True)
+        )
+        self.total = objects.identifier.nunique() if total is None else total
+
+    def getStatistics(self):
+        return {'objects': self.total, 'people': len(self.people), 'hasAuthor': {}}
+
+    def getAllCulturalHeritageObjects(self):
+        return self.objects
+
+    def getAllPeople(self):
+        return self.people
+
+    def getEntities(self, entityName='CHO', select_only=None, by=None, value=None):
+        values = [value] if isinstance(value, str) else list(value)
+        if entityName == 'Person':
+            return self.people[self.people.identifier.isin(values)]
+        if by == 'identifier':
+            df = self.objects[self.objects.identifier.isin(values)]
+        else: # Authored by
+            df = self.objects[self.objects.p_identifier.isin(values)]
+        return df['identifier'].to_numpy() if select_only else df
+
+    def getById(self, identifier):
+        df = self.getEntities(by='identifier', value=[identifier])
+        return df if not df.empty else self.getEntities('Person', by='identifier', value=[identifier])
+
+    def getAuthorsOfCulturalHeritageObject(self, objectId):
+        values = [objectId] if isinstance(objectId, str) else objectId
+        return self.getEntities('Person', value=self.objects.loc[self.objects.identifier.isin(values), 'p_identifier'])
+
+def interpreted_toRDF(handler: MetadataUploadHandler, df: pd.DataFrame, entityName: str = BASE) -> Generator[str, None, None]:
+    """
+    The previous conversion, for reference.
+    """
+    entityMap = IDE[entityName]
+    entity, attrs = entityMap['entity'], entityMap['attributes']
+    for col in df:
+        df[col] = df[col].str.strip()
+    if 'class' in df:
+        df['class'] = df['class'].map(handler._check_class, na_action='ignore')
+        df.dropna(subset=['identifier', 'class'], inplace=True)
+    else:
+        df.dropna(subset='identifier', inplace=True)
+    df.index = df.identifier.map(lambda identifier: f'loc:{entityName}-{quote_plus(identifier)}')
+
+    if 'class' in attrs:
+        class_ns = attrs['class'].vtype
+        for c in df['class'].unique():
+            yield f'{class_ns}:{c} rdfs:subClassOf {entity} .'
+    else:
+        for s in df.index:
+            yield f'{s} rdf:type {entity} .'
+
+    if (rank := entityMap['rank']):
+        for s, o in zip(df.index, df[entityMap['sort_by']].map(rank).to_list()):
+            yield f'{s} loc:rank {o} .'
+
+    for name, attr in attrs.items():
+        p = attr.predicate
+        col = df[name].str.split(attr.sep).explode().dropna() if attr.sep else df[name].dropna()
+        if isinstance((ns := attr.vtype), str):
+            for s, o in zip(col.index, col.to_list()):
+                yield f'{s} {p} {ns}:{o} .'
+        elif isinstance((rel := attr.vtype), Relation):
+            df2 = col.str.extract(rel.pattern).dropna(subset=['identifier'])
+            for s, id2 in zip(df2.index, df2.identifier.to_list()):
+                yield f'{s} {p} loc:{rel.name}-{quote_plus(id2)} .'
+            yield from interpreted_toRDF(handler, df2, rel.name)
+        else:
+            for s, o in zip(col.index, col.to_list()):
+                yield f'{s} {p} "{o}" .'
+
+def metadata(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Metadata rows in the layout of the CSV files, with up to two authors per object drawn from rows // 20 people.
+    """
+    rng = np.random.default_rng(seed)
+    people = max(1, rows // 20)
+    first, second = rng.integers(0, people, size=rows), rng.integers(0, people, size=rows)
+    authors = pd.Series([f'Name {a} (VIAF:{a}); Name {b} (VIAF:{b})' for a, b in zip(first, second)])
+    authors[rng.random(rows) < 0.3] = None
+    return pd.DataFrame({
+        'identifier': pd.Series(np.arange(rows)).astype(str),
+        'class': rng.choice(['Painting', 'Map', 'Printed volume', 'Specimen'], size=rows),
+        'title': [f'Title {i}' for i in range(rows)],
+        'date': pd.Series(rng.integers(1400, 1900, size=rows)).astype(str),
+        'hasAuthor': authors,
+        'owner': rng.choice(['BUB', 'FICLIT', 'MUSPAL'], size=rows),
+        'place': rng.choice(['Bologna', 'Ravenna'], size=rows)
+    }, columns=list(IDE[BASE]['attributes'])).astype('string')
+
+class Test_01_ProcessSchema(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        p = 'streamlod' + sep + 'data' + sep + 'process.json'
+        rdb = 'streamlod' + sep + 'databases' + sep + 'relational_plain.db'
+        rdbn = 'streamlod' + sep + 'databases' + sep + 'relational_normalized.db'
+
+        puh = ProcessDataUploadHandler()
+        puh.setDbPathOrUrl(rdb, reset=True)
+        puh.pushDataToDb(p)
+        puh.setDbPathOrUrl(rdbn, reset=True, normalized=True)
+        puh.pushDataToDb(p)
+
+        cls.q = ProcessDataQueryHandler()
+        cls.q.setDbPathOrUrl(rdb)
+        cls.qn = ProcessDataQueryHandler()
+        cls.qn.setDbPathOrUrl(rdbn)
+
+    def test_01_tools(self):
+        df = self.q.getById('1')
+        self.assertEqual(df['tool'].iloc[3], {'Gimp', 'Instant Meshes', 'Blender'})
+
+        # Activities without tools
+        df = self.q.getById('2')
+        self.assertIsNone(df['tool'].iloc[0])
+
+        # Every tool of the matching activities is returned, not only the matching one
+        for tools in self.q.getActivitiesUsingTool('Gimp')['tool']:
+            self.assertIn('Gimp', tools)
+            self.assertGreater(len(tools), 1)
+
+    def test_02_order(self):
+        df = self.q.getAllActivities()
+        sorted_df = df.sort_values(by=['refersTo', 'class'], key=sorter, kind='stable')
+        self.assertEqual(df['refersTo'].tolist(), sorted_df['refersTo'].tolist())
+        self.assertEqual(df['class'].tolist(), sorted_df['class'].tolist())
+
+    def test_03_dates(self):
+        # Partial dates are intervals of days
+        self.assertEqual(len(self.q.getActivitiesStartedAfter('2023-10')), len(self.q.getActivitiesStartedAfter('2023-10-01')))
+        self.assertEqual(len(self.q.getActivitiesEndedBefore('2023-03')), len(self.q.getActivitiesEndedBefore('2023-03-31')))
+        for start in self.q.getActivitiesStartedAfter('2023-10-24')['start']:
+            self.assertGreaterEqual(start, '2023-10-24')
+
+    def test_04_normalized(self):
+        queries = [
+            ('getAllActivities',),
+            ('getActivitiesByResponsibleInstitution', 'itage'),
+            ('getActivitiesByResponsiblePerson', 'y B'),
+            ('getActivitiesUsingTool', 'lab-'),
+            ('getAcquisitionsByTechnique', '3d'),
+            ('getById', ['1', '13'])
+        ]
+        for method, *args in queries:
+            df = getattr(self.q, method)(*args).fillna('')
+            dfn = getattr(self.qn, method)(*args).fillna('')
+            self.assertEqual(df.to_dict('records'), dfn.to_dict('records'))
+
+        # The schema is read once per path, not by every query or streamed chunk
+        qn = ProcessDataQueryHandler()
+        qn.setDbPathOrUrl(self.qn.getDbPathOrUrl())
+        with mock.patch('streamlod.handlers.process._is_normalized', return_value=True) as check:
+            qn.getAcquisitionsByTechnique('3d')
+            list(qn.iterActivities(chunksize=7))
+            self.assertEqual(check.call_count, 1)
+        self.assertTrue(qn.isNormalized())
+        self.assertFalse(self.q.isNormalized())
+
+    def test_05_streaming(self):
+        df = self.q.getAllActivities()
+        chunks = list(self.q.iterActivities(chunksize=7))
+        self.assertEqual(len(chunks), -(-len(df) // 7))
+        self.assertEqual(pd.concat(chunks, ignore_index=True).fillna('').to_dict('records'), df.fillna('').to_dict('records'))
+
+        for batch in self.qn.iterActivities(chunksize=7, records=True):
+            for row in batch:
+                self.assertIsInstance(row, tuple)
+                self.assertEqual(len(row), len(df.columns))
+
+
+class Test_02_ProcessIngestion(unittest.TestCase):
+    shards = 3
+
+    @classmethod
+    def setUpClass(cls):
+        # The same data in a single database and in shards, shared by the tests reading them
+        p = 'streamlod' + sep + 'data' + sep + 'process.json'
+        cls.single = 'streamlod' + sep + 'databases' + sep + 'relational_single.db'
+        cls.sharded = 'streamlod' + sep + 'databases' + sep + 'relational_sharded.db'
+
+        puh = ProcessDataUploadHandler()
+        puh.setDbPathOrUrl(cls.single, reset=True)
+        puh.pushDataToDb(p)
+        puh.setDbPathOrUrl(cls.sharded, reset=True, shards=cls.shards)
+        puh.pushDataToDb(p)
+
+        cls.q = ProcessDataQueryHandler()
+        cls.q.setDbPathOrUrl(cls.single)
+
+    def test_01_push_many(self):
+        ps = [
+            'streamlod' + sep + 'data' + sep + 'process.json',
+            'streamlod' + sep + 'data' + sep + 'multi' + sep + 'process1.json',
+            'streamlod' + sep + 'data' + sep + 'multi' + sep + 'process2.json'
+        ]
+        rdb1 = 'streamlod' + sep + 'databases' + sep + 'relational_sequential.db'
+        rdb2 = 'streamlod' + sep + 'databases' + sep + 'relational_parallel.db'
+
+        puh = ProcessDataUploadHandler()
+        puh.setDbPathOrUrl(rdb1, reset=True)
+        for p in ps:
+            self.assertTrue(puh.pushDataToDb(p))
+        # Pushes are idempotent, the same files can be pushed again in parallel
+        puh.setDbPathOrUrl(rdb2, reset=True)
+        self.assertTrue(puh.pushManyToDb(ps + ps, workers=2))
+        self.assertFalse(puh.pushManyToDb(ps + ['not_a_file.json'], workers=2))
+
+        # A file failing in the writer is rolled back and the others are still drained
+        distribute = puh._distribute
+        def failing(cons, df):
+            if '1' in df['refersTo'].values:
+                raise sqlite3.IntegrityError('Malformed batch')
+            distribute(cons, df)
+        puh._distribute = failing
+        self.assertFalse(puh.pushManyToDb(ps * 3, workers=2, queue_size=1))
+        del puh._distribute
+
+        q1 = ProcessDataQueryHandler()
+        q1.setDbPathOrUrl(rdb1)
+        q2 = ProcessDataQueryHandler()
+        q2.setDbPathOrUrl(rdb2)
+        self.assertEqual(q1.getAllActivities().fillna('').to_dict('records'), q2.getAllActivities().fillna('').to_dict('records'))
+
+    def test_02_shards(self):
+        # Pushing again to the shards is idempotent
+        puh = ProcessDataUploadHandler()
+        puh.setDbPathOrUrl(self.sharded)
+        self.assertTrue(puh.pushDataToDb('streamlod' + sep + 'data' + sep + 'process.json'))
+
+        q1 = self.q
+        q2 = ProcessDataQueryHandler()
+        q2.setDbPathOrUrl(self.sharded)
+        for method, *args in [('getAllActivities',), ('getById', '13'), ('getById', ['1', '2', '29']), ('getActivitiesUsingTool', 'Blender')]:
+            df1 = getattr(q1, method)(*args).fillna('')
+            df2 = getattr(q2, method)(*args).fillna('')
+            self.assertEqual(df1.to_dict('records'), df2.to_dict('records'))
+
+        # Sorted streams of the shards are merged
+        df = pd.concat(q2.iterActivities(chunksize=10), ignore_index=True).fillna('')
+        self.assertEqual(df.to_dict('records'), q1.getAllActivities().fillna('').to_dict('records'))
+
+        # Numeric identifiers are looked up as the stored strings
+        self.assertEqual(q2.getById(13).fillna('').to_dict('records'), q1.getById('13').fillna('').to_dict('records'))
+        self.assertEqual(len(q2.getById([1, '2', 2])), len(q1.getById(['1', '2'])))
+
+        # A shard that cannot be read is skipped, the values of the others are still streamed
+        paths = _shard_paths(self.sharded)
+        with mock.patch('streamlod.handlers.process._shard_paths', return_value=[':memory:'] + paths):
+            self.assertEqual(sorted(q2.getAttribute()), sorted(q1.getAttribute()))
+
+    def test_03_routes(self):
+        p1 = 'streamlod' + sep + 'data' + sep + 'multi' + sep + 'process1.json'
+        p2 = 'streamlod' + sep + 'data' + sep + 'multi' + sep + 'process2.json'
+        rdb1 = 'streamlod' + sep + 'databases' + sep + 'relational_routed1.db'
+        rdb2 = 'streamlod' + sep + 'databases' + sep + 'relational_routed2.db'
+
+        puh = ProcessDataUploadHandler()
+        for p, rdb in [(p1, rdb1), (p2, rdb2)]:
+            puh.setDbPathOrUrl(rdb, reset=True)
+            puh.pushDataToDb(p)
+        q1, q2 = ProcessDataQueryHandler(), ProcessDataQueryHandler()
+        q1.setDbPathOrUrl(rdb1)
+        q2.setDbPathOrUrl(rdb2)
+        identifiers = q2.getAttribute()
+
+        # A new handler of existing databases routes the identifiers already stored in them
+        first, other = ProcessDataUploadHandler(), ProcessDataUploadHandler()
+        first.setDbPathOrUrl(rdb1)
+        other.setDbPathOrUrl(rdb2)
+        self.assertEqual(other.identifiers.capacity, 100000)
+        for identifier in identifiers:
+            self.assertIn(identifier, other.identifiers)
+        self.assertNotIn('just_a_test', other.identifiers)
+
+        # Lookups reach only the databases holding the identifiers, with the same result
+        m = AdvancedMashup()
+        m.addProcessHandler(q1, route=first.identifiers)
+        m.addProcessHandler(q2, route=other.identifiers)
+        fetched = []
+        fetch = lambda handler, ids: fetched.append(handler) or handler.getById(ids)
+        identifier = min(set(identifiers) - set(q1.getAttribute()))
+        dfs = m._semiJoin([[identifier, 'just_a_test']], m.processQuery, m.processRoutes, fetch)
+        self.assertEqual(fetched, [q2])
+        self.assertEqual(dfs[0].fillna('').to_dict('records'), q2.getById(identifier).fillna('').to_dict('records'))
+        self.assertEqual(m._semiJoin([['just_a_test']], m.processQuery, m.processRoutes, fetch), [])
+
+        # The filter is rebuilt from the database, in place, when the pushes would exceed its capacity
+        route = other.identifiers
+        other._track([str(i) for i in range(route.capacity)])
+        self.assertIs(other.identifiers, route)
+        self.assertEqual(route.count, len(set(identifiers)))
+        self.assertNotIn(str(route.capacity - 1), route)
+
+    def test_04_replicas(self):
+        rdb = self.single
+
+        class SlowHandler(ProcessDataQueryHandler):
+            delay = 0.3
+            def getById(self, id):
+                sleep(self.delay)
+                return super().getById(id)
+
+        slow, fast = SlowHandler(), ProcessDataQueryHandler()
+        slow.setDbPathOrUrl(rdb)
+        fast.setDbPathOrUrl(rdb)
+
+        # A single source for the mashup, preferring the fastest replica once both were tried
+        group = ReplicaGroup(slow, fast, min_samples=4)
+        self.addCleanup(group.close)
+        m = AdvancedMashup()
+        m.addProcessHandler(group)
+        expected = fast.getAllActivities().fillna('').to_dict('records')
+        self.assertEqual(group.getAllActivities().fillna('').to_dict('records'), expected)
+        self.assertEqual(len(m.getAllActivities()), 0) # No metadata handler, no objects to link
+        for _ in range(4):
+            self.assertEqual(group.getById('1').fillna('').to_dict('records'), fast.getById('1').fillna('').to_dict('records'))
+        self.assertLess(group.latency['getById'][1], group.latency['getById'][0])
+        # Latencies are kept per method, streams are passed through untimed
+        self.assertEqual(len(group.samples['getById']), 4)
+        self.assertIn('getAllActivities', group.samples)
+        self.assertEqual(len(list(group.iterActivities(chunksize=10))), len(list(fast.iterActivities(chunksize=10))))
+        self.assertNotIn('iterActivities', group.samples)
+
+        # A primary slower than the 95th percentile is hedged by the next replica
+        fast.getById = lambda id: sleep(1) or pd.DataFrame()
+        result = group.getById('1')
+        self.assertGreater(group.hedged, 0)
+        self.assertEqual(result.fillna('').to_dict('records'), slow.getById('1').fillna('').to_dict('records'))
+
+        # A failing replica is ranked last, and its failures are not latency samples
+        class BrokenHandler(ProcessDataQueryHandler):
+            def getById(self, id):
+                raise sqlite3.OperationalError('database is locked')
+
+        broken = BrokenHandler()
+        broken.setDbPathOrUrl(rdb)
+        with ReplicaGroup(broken, slow) as group:
+            self.assertEqual(len(group.getById('1')), len(slow.getById('1')))
+            self.assertEqual(len(group.samples['getById']), 1)
+            self.assertIsNone(group.latency['getById'][0])
+            self.assertEqual(group.failures['getById'], [1, 0])
+            self.assertEqual(group._ranked('getById'), [1, 0])
+
+        with ReplicaGroup(fast) as closed:
+            pass
+        self.assertRaises(RuntimeError, closed.getAllActivities)
+
+    def test_05_identity_map(self):
+        rdb = self.single
+        rows = [
+            ['Painting', '1', 'A', 'Owner', 'Place', None, 'VIAF:1', 'Anna'],
+            ['Painting', '1', 'A', 'Owner', 'Place', None, 'VIAF:2', 'Bob'],
+            ['Map', '2', 'B', 'Owner', 'Place', '1900', None, None],
+            ['Model', '3', 'C', 'Owner', 'Place', None, 'VIAF:1', 'Anna']
+        ]
+        m = AdvancedMashup(cache_size=2)
+        objects = m.toCHO(pd.DataFrame(rows[:3], columns=COLUMNS))
+        self.assertTrue(all(x is y for x, y in zip(objects, m.toCHO(pd.DataFrame(rows[:3], columns=COLUMNS)))))
+
+        # Activities are linked to the cached objects, without any metadata handler to fetch them from
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+        m.addProcessHandler(q)
+        activities = m.getActivitiesUsingTool('')
+        self.assertEqual({a.refersTo().identifier for a in activities}, {'1', '2'})
+        self.assertTrue(all(a.refersTo() is objects[int(a.refersTo().identifier) - 1] for a in activities))
+
+        # Bounded least recently used, shared people
+        model = m.toCHO(pd.DataFrame(rows[3:], columns=COLUMNS))[0]
+        self.assertEqual(list(m.objects), ['2', '3'])
+        self.assertIs(model.hasAuthor[0], objects[0].hasAuthor[0])
+        m.invalidate(['2'])
+        self.assertEqual(list(m.objects), ['3'])
+        m.invalidate()
+        self.assertFalse(m.objects or m.people)
+
+        # Threads building, evicting and invalidating the same entries share the instances in the map
+        m = AdvancedMashup(cache_size=2)
+        frames = [pd.DataFrame(rows[i:i + 2], columns=COLUMNS) for i in range(3)]
+        def build(i):
+            if i % 7 == 0:
+                m.invalidate()
+            return m.toCHO(frames[i % 3])
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            built = list(executor.map(build, range(200)))
+        self.assertTrue(all(len(objects) for objects in built))
+        self.assertLessEqual(len(m.objects), 2)
+        for identifier, obj in list(m.objects.items()):
+            self.assertIs(m._cached(m.objects, identifier), obj)
+
+    def test_06_integration(self):
+        df1 = pd.DataFrame([
+            ['Painting', '10', 'A', 'Owner', 'Place', None, 'VIAF:1', 'Anna'],
+            ['Map', '2', 'B', None, 'Place', None, None, None]
+        ], columns=COLUMNS)
+        df2 = pd.DataFrame([
+            ['Painting', '10', None, None, None, '1900', 'VIAF:2', 'Bob'],
+            ['Map', '2', 'B', 'Owner', None, None, None, None]
+        ], columns=COLUMNS)
+
+        # Attributes are coalesced per object, authors from every source are kept
+        objects = AdvancedMashup().toCHO([df1, df2])
+        self.assertEqual([obj.identifier for obj in objects], ['2', '10'])
+        self.assertEqual((objects[0].owner, objects[0].place), ('Owner', 'Place'))
+        self.assertEqual((objects[1].title, objects[1].date), ('A', '1900'))
+        self.assertEqual([person.name for person in objects[1].hasAuthor], ['Anna', 'Bob'])
+
+        people = AdvancedMashup().toPerson([
+            pd.DataFrame([['VIAF:1', 'Anna'], ['VIAF:2', None]], columns=['identifier', 'name']),
+            pd.DataFrame([['VIAF:2', 'Bob'], ['VIAF:3', None]], columns=['identifier', 'name'])
+        ])
+        self.assertEqual([(person.identifier, person.name) for person in people], [('VIAF:1', 'Anna'), ('VIAF:2', 'Bob')])
+
+    def test_07_lazy(self):
+        rdb = self.single
+        df = pd.DataFrame([
+            ['Painting', '1', 'A', 'Owner', 'Place', None, 'VIAF:1', 'Anna'],
+            ['Painting', '1', 'A', 'Owner', 'Place', None, 'VIAF:2', 'Bob'],
+            ['Map', '2', 'B', 'Owner', 'Place', '1900', None, None]
+        ], columns=COLUMNS)
+
+        eager, lazy = AdvancedMashup(), AdvancedMashup(lazy=True)
+        objects = lazy.toCHO(df.copy())
+        self.assertIsInstance(objects, LazySequence)
+        self.assertEqual(len(objects), 2)
+        self.assertEqual(list(objects.keys), ['1', '2'])
+        self.assertEqual(objects._built, [None, None]) # Nothing built before access
+        self.assertEqual(objects[-1:], eager.toCHO(df.copy())[-1:])
+        self.assertEqual(objects._built[0], None)
+        self.assertIs(objects[1], objects[1])
+        self.assertEqual(objects, eager.toCHO(df.copy()))
+
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+        activities = lazy.toActivity(q.getById(['1', '2']))
+        self.assertEqual(len(activities), 0) # No metadata handler holding the objects
+        lazy.cacheSize = 2
+        lazy.toCHO(df.copy())[0]
+        activities = lazy.toActivity(q.getById(['1', '2', '3']))
+        self.assertEqual(len(activities), len(q.getById(['1'])))
+        self.assertTrue(all(activity.refersTo().identifier == '1' for activity in activities))
+
+    def test_08_semi_join(self):
+        rdb = self.sharded
+        events = []
+
+        class Process(ProcessDataQueryHandler):
+            def iterAttribute(self, *args, **kwargs):
+                for batch in super().iterAttribute(*args, **kwargs):
+                    events.append(('produced', len(batch)))
+                    yield batch
+                    sleep(0.05) # Leave time to the second phase
+
+        class Metadata(FakeMetadata):
+            def getEntities(self, entityName='CHO', select_only=None, by=None, value=None):
+                events.append(('fetched', list(value)))
+                return super().getEntities(entityName, select_only, by, value)
+
+        q = Process()
+        q.setDbPathOrUrl(rdb)
+        m = AdvancedMashup(batch_size=3)
+        m.addProcessHandler(q)
+        m.addMetadataHandler(Metadata(fake_objects([]), total=1000)) # Few objects match: semi-join
+        self.assertEqual(m.getObjectsHandledByResponsiblePerson(''), [])
+
+        # Batches are bounded, sent once per identifier, and fetched while the next ones are produced
+        fetched = [ids for event, ids in events if event == 'fetched']
+        self.assertTrue(all(0 < len(ids) <= 3 for ids in fetched))
+        self.assertEqual(sorted(chain.from_iterable(fetched)), sorted(set(q.getAttribute())))
+        self.assertLess(events.index(('fetched', fetched[0])), len(events) - len(fetched))
+
+        # Large identifier sets go through a temporary table
+        ids = [str(i) for i in range(300)]
+        self.assertEqual(q.getById(ids).fillna('').to_dict('records'), q.getAllActivities().fillna('').to_dict('records'))
+
+    def test_09_planner(self):
+        rdb = self.sharded
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+        statistics = q.getStatistics()
+        self.assertEqual(statistics['activities'], len(q.getAllActivities()))
+        self.assertEqual(statistics['objects'], len(set(q.getAttribute())))
+        self.assertEqual(q.estimate('tool', 'blender'), len(q.getActivitiesUsingTool('blender')))
+
+        # Statistics are kept up to date by the writes, and untouched by pushes inserting nothing
+        ps = ['streamlod' + sep + 'data' + sep + 'multi' + sep + 'process1.json', 'streamlod' + sep + 'data' + sep + 'process.json']
+        rdb2 = 'streamlod' + sep + 'databases' + sep + 'relational_statistics.db'
+        puh = ProcessDataUploadHandler()
+        for options in ({}, {'normalized': True}, {'shards': 2}):
+            puh.setDbPathOrUrl(rdb2, reset=True, **options)
+            for p in ps:
+                self.assertTrue(puh.pushDataToDb(p))
+            for db in _shard_paths(rdb2):
+                self.assertEqual(stored_statistics(db), stored_statistics(db, recompute=True))
+            with mock.patch.object(puh, '_analyze') as analyze:
+                self.assertTrue(puh.pushDataToDb(ps[1]))
+                analyze.assert_not_called()
+
+        # A failed update of the statistics keeps the push, and they are recomputed by the next one
+        puh.setDbPathOrUrl(rdb2, reset=True)
+        with mock.patch.object(puh, '_count', side_effect=ValueError('No statistics')):
+            self.assertTrue(puh.pushDataToDb(ps[0]))
+        self.assertNotIn('activities', [row[0] for row in stored_statistics(rdb2)])
+        self.assertTrue(puh.pushDataToDb(ps[1]))
+        self.assertEqual(stored_statistics(rdb2), stored_statistics(rdb2, recompute=True))
+
+        objects = fake_objects(sorted(set(q.getAttribute()), key=int))
+
+        # Most of the objects match: hash join; few of many: semi-join, with the same results
+        results, plans = [], []
+        for total in (len(objects), 1000):
+            m = AdvancedMashup()
+            m.addProcessHandler(q)
+            m.addMetadataHandler(FakeMetadata(objects, total))
+            results.append(m.getObjectsHandledByResponsibleInstitution(''))
+            plans.append(m.lastPlan)
+            results.append(m.getAuthorsOfObjectsAcquiredInTimeFrame('2023', '2024'))
+            plans.append(m.lastPlan)
+        self.assertEqual(plans, ['hash join', 'hash join', 'semi-join', 'semi-join'])
+        self.assertEqual(results[:2], results[2:])
+        self.assertEqual(len(results[0]), len(objects))
+        self.assertGreater(len(results[1]), 0)
+
+        # Matching activities are compared with the objects as the distinct objects they refer to
+        m = AdvancedMashup()
+        m.addProcessHandler(q)
+        m.addMetadataHandler(FakeMetadata(objects, 3 * len(objects)))
+        self.assertGreater(statistics['activities'], m.hashJoinRatio * 3 * len(objects))
+        self.assertEqual(m._distinctObjects(statistics['activities']), len(objects))
+        self.assertEqual(m._distinctObjects(0), 0)
+        self.assertEqual(len(m.getObjectsHandledByResponsibleInstitution('')), len(objects))
+        self.assertEqual(m.lastPlan, 'semi-join')
+
+        # A narrow time frame is estimated on the days it covers, not on all the acquisitions
+        m = AdvancedMashup()
+        m.addProcessHandler(q)
+        m.addMetadataHandler(FakeMetadata(objects, len(objects)))
+        authors = m.getAuthorsOfObjectsAcquiredInTimeFrame('2023-05-08', '2023-05-08')
+        self.assertEqual(m.lastPlan, 'semi-join')
+        self.assertLess(len(authors), len(results[1]))
+        self.assertGreater(len(authors), 0)
+
+    def test_10_materialized_view(self):
+        p1 = 'streamlod' + sep + 'data' + sep + 'multi' + sep + 'process1.json'
+        p2 = 'streamlod' + sep + 'data' + sep + 'multi' + sep + 'process2.json'
+        rdb = 'streamlod' + sep + 'databases' + sep + 'relational_source.db'
+        view_db = 'streamlod' + sep + 'databases' + sep + 'relational_view.db'
+
+        objects = fake_objects(range(1, 36), authors=5)
+
+        puh = ProcessDataUploadHandler()
+        puh.setDbPathOrUrl(rdb, reset=True)
+        puh.pushDataToDb(p1)
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+        source = AdvancedMashup()
+        source.addMetadataHandler(FakeMetadata(objects))
+        source.addProcessHandler(q)
+
+        view = MaterializedView(view_db, source, reset=True)
+        self.assertIsNone(view.getStaleness())
+        self.assertTrue(view.refresh())
+        m = view.toMashup()
+        self.assertLess(view.getStaleness(), 60)
+
+        def same(method, *args):
+            self.assertEqual(getattr(m, method)(*args), getattr(source, method)(*args))
+
+        for method, *args in [
+            ('getAllActivities',), ('getAllPeople',), ('getEntityById', '3'), ('getEntityById', 'VIAF:2'),
+            ('getActivitiesOnObjectsAuthoredBy', 'VIAF:1'), ('getObjectsHandledByResponsiblePerson', 'a'),
+            ('getAuthorsOfObjectsAcquiredInTimeFrame', '2023', '2024')
+        ]:
+            same(method, *args)
+
+        # Pushes to the sources are refreshed incrementally
+        view.listen(puh)
+        before = len(m.getAllActivities())
+        puh.pushDataToDb(p2)
+        self.assertFalse(view.pending)
+        self.assertGreater(len(m.getAllActivities()), before)
+        same('getAllActivities')
+        self.assertEqual(stored_statistics(view_db), stored_statistics(view_db, recompute=True))
+
+        # Workers of a parallel push get plain settings, not the handler with its listeners
+        self.assertTrue(puh.pushManyToDb([p1, p2], workers=2))
+        self.assertFalse(view.pending)
+
+        # A refresh failing to write is rolled back, and its identifiers stay pending
+        view.pending.add('1')
+        before = m.getAllActivities()
+        with mock.patch.object(view, '_insertActivities', side_effect=sqlite3.OperationalError('database is locked')):
+            self.assertFalse(view.refresh(incremental=True))
+        self.assertEqual(view.pending, {'1'})
+        self.assertEqual(m.getAllActivities(), before)
+        self.assertTrue(view.refresh(incremental=True))
+        same('getAllActivities')
+
+        # A failing listener does not change the result of the push, and the next listeners are still called
+        def locked(identifiers):
+            raise sqlite3.OperationalError('database is locked')
+        notified = []
+        puh.listeners.insert(0, locked)
+        puh.addListener(notified.append)
+        self.assertTrue(puh.pushDataToDb(p1))
+        self.assertTrue(puh.pushManyToDb([p2], workers=1))
+        self.assertEqual(len(notified), 2)
+
+    def test_11_single_flight(self):
+        rdb = self.sharded
+        calls = []
+
+        class Counted(ProcessDataQueryHandler):
+            def _getShardActivities(self, *args):
+                calls.append(args)
+                sleep(0.2)
+                return super()._getShardActivities(*args)
+
+        q = Counted()
+        q.setDbPathOrUrl(rdb)
+        q.getAllActivities()
+        self.assertEqual(len(calls), self.shards) # One query per shard
+        calls.clear()
+
+        # Identifier lists are the same query whatever their order
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda ids: q.getById(ids), [['1', '2'], ['2', '1']] * 4))
+        self.assertEqual(len(calls), len(set(a[0] for a in calls)))
+        self.assertLessEqual(len(calls), self.shards)
+        self.assertEqual(q.flight.coalesced, 7)
+        for df in results[1:]:
+            self.assertIsNot(df, results[0])
+            self.assertEqual(df.fillna('').to_dict('records'), results[0].fillna('').to_dict('records'))
+
+        # Tasks and threads share the same in-flight mashup query
+        m = AdvancedMashup()
+        m.addProcessHandler(q)
+        calls.clear()
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            threaded = loop.run_in_executor(None, m.getActivitiesUsingTool, 'Blender')
+            await asyncio.sleep(0.05)
+            tasks = [m.asyncQuery('getActivitiesUsingTool', 'Blender') for _ in range(5)]
+            return await asyncio.gather(threaded, *tasks)
+
+        results = asyncio.run(run())
+        self.assertEqual(m.flight.coalesced, 5)
+        self.assertEqual(len(calls), self.shards)
+        self.assertTrue(all(result == results[0] for result in results))
+
+        # Followers get their own list of the same entities
+        people = [Person('VIAF:1', 'Anna')]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(m.flight.do, 'people', lambda: sleep(0.2) or people)
+            sleep(0.05)
+            follower = executor.submit(m.flight.do, 'people', lambda: [Person('VIAF:1', 'Anna')])
+        self.assertIsNot(follower.result(), leader.result())
+        self.assertIs(follower.result()[0], leader.result()[0])
+
+    def test_12_misses(self):
+        calls = []
+        stored = {'10': ['Painting', '10', 'A', None, None, None, None, None]}
+
+        class Metadata(MetadataQueryHandler):
+            def getEntities(self, entityName='CHO', select_only=None, by=None, value=None):
+                calls.append((entityName, value))
+                rows = [stored[value]] if entityName == 'CHO' and value in stored else []
+                return pd.DataFrame(rows, columns=COLUMNS if entityName == 'CHO' else ['identifier', 'name'])
+
+        q = Metadata()
+        q.setDbPathOrUrl('http://localhost')
+        upload = ProcessDataUploadHandler()
+
+        # Misses are not remembered by default, a new identifier is found as soon as it is stored
+        self.assertTrue(q.getById('11').empty)
+        self.assertTrue(q.getById('11').empty)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(q.misses), 0)
+        self.assertEqual(len(AdvancedMashup().misses), 0)
+        calls.clear()
+        q.follow(upload)
+
+        # A miss queries the database once until it expires or is pushed
+        self.assertTrue(q.getById('11').empty)
+        self.assertTrue(q.getById('11').empty)
+        self.assertEqual(len(calls), 2)
+        stored['11'] = ['Map', '11', 'B', None, None, None, None, None]
+        upload._notify(['11'])
+        self.assertFalse(q.getById('11').empty)
+
+        q.misses.ttl = 0
+        q.getById('12')
+        calls.clear()
+        q.getById('12')
+        self.assertEqual(len(calls), 2)
+
+        # Identifiers outside the known ones are not queried at all
+        q.known = BloomFilter(['10', '11'])
+        calls.clear()
+        self.assertTrue(q.getById('13').empty)
+        self.assertFalse(q.getById('10').empty)
+        self.assertEqual(len(calls), 1)
+        upload._notify(['13'])
+        self.assertIn('13', q.known)
+
+        q = Metadata()
+        q.setDbPathOrUrl('http://localhost')
+        q.follow(upload)
+        m = AdvancedMashup()
+        m.addMetadataHandler(q)
+        m.follow(upload)
+        calls.clear()
+        self.assertIsNone(m.getEntityById('14'))
+        self.assertIsNone(m.getEntityById('14'))
+        self.assertEqual(len(calls), 2)
+        stored['14'] = ['Map', '14', 'C', 'Owner', 'Place', None, None, None]
+        upload._notify(['14'])
+        self.assertEqual(m.getEntityById('14').title, 'C')
+
+    def test_13_columnar(self):
+        rdb = self.single
+        objects = fake_objects(range(1, 21), authors=3)
+        objects = pd.concat([objects, objects.iloc[[2]].assign(p_identifier='VIAF:9', p_name='Name 9')]).sort_index(kind='stable')
+
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+        eager, columnar = AdvancedMashup(), AdvancedMashup(columnar=True)
+        for m in (eager, columnar):
+            m.addMetadataHandler(FakeMetadata(objects))
+            m.addProcessHandler(q)
+
+        # Batches and views of no entity cannot be built
+        self.assertRaises(TypeError, EntityBatch, objects)
+        self.assertRaises(TypeError, RowView, ObjectBatch(objects), 0)
+
+        chos = columnar.getAllCulturalHeritageObjects()
+        self.assertIsInstance(chos, ObjectBatch)
+        self.assertEqual(chos, eager.getAllCulturalHeritageObjects())
+        self.assertEqual(list(chos['identifier'][:3]), ['1', '2', '3'])
+        self.assertEqual([person.name for person in chos[2].getAuthors()], ['Name 0', 'Name 9'])
+        self.assertEqual(len(chos.to_pandas()), 20)
+
+        activities = columnar.getAllActivities()
+        self.assertIsInstance(activities, ActivityBatch)
+        self.assertEqual(activities, eager.getAllActivities())
+        self.assertEqual(activities, columnar.toActivity(activities.to_pandas()))
+        acquisitions = activities.filter(activities['class'] == 'Acquisition')
+        self.assertEqual([a.getTechnique() for a in acquisitions], [a.getTechnique() for a in eager.getAcquisitionsByTechnique('')])
+        self.assertEqual(acquisitions[0].refersTo().getTitle(), 'Title ' + acquisitions['refersTo'][0])
+        self.assertEqual(activities.to_arrow().num_rows, len(activities))
+        self.assertEqual(activities[1:3], eager.getAllActivities()[1:3])
+
+    def test_14_resume(self):
+        rdb = 'streamlod' + sep + 'databases' + sep + 'relational_resume.db'
+        expected = self.q.getAllActivities().fillna('').to_dict('records')
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+
+        def flaky(puh):
+            """
+            Makes the batches of a handler fail as listed in its failures, by batch number.
+            """
+            puh.backoff, puh.batchSize, puh.failures, commit = 0, 5, [], puh._commit
+            def _commit(cons, df, source, batches):
+                if puh.failures and puh.failures[0][0] == batches:
+                    raise puh.failures.pop(0)[1]
+                return commit(cons, df, source, batches)
+            puh._commit = _commit
+            return puh
+
+        with TemporaryDirectory() as directory:
+            with open('streamlod' + sep + 'data' + sep + 'process.json') as file:
+                records = json.load(file)
+            paths = [directory + sep + 'process.jsonl', directory + sep + 'process.json']
+            with open(paths[0], 'w') as file:
+                file.writelines(json.dumps(record) + '\n' for record in records)
+            with open(paths[1], 'w') as file:
+                json.dump(records, file)
+
+            # Both streamed and whole documents are committed in batches, by single and parallel pushes
+            for path, many in [(paths[0], False), (paths[1], False), (paths[1], True)]:
+                puh = flaky(ProcessDataUploadHandler())
+                puh.setDbPathOrUrl(rdb, reset=True)
+                if many:
+                    push = lambda path, **kwargs: puh.pushManyToDb([path], workers=1, **kwargs)
+                else:
+                    push = puh.pushDataToDb
+
+                # A locked database is retried, a missing table fails the push after the committed batches
+                puh.failures = [(2, sqlite3.OperationalError('database is locked')), (3, sqlite3.OperationalError('no such table: Foo'))]
+                self.assertFalse(push(path))
+                self.assertEqual(len(q.getAllActivities().refersTo.unique()), 10)
+
+                # The push resumes after the last committed batch
+                self.assertTrue(push(path, resume=True))
+                self.assertEqual(q.getAllActivities().fillna('').to_dict('records'), expected)
+                self.assertTrue(push(path, resume=True)) # Nothing left
+                with sqlite3.connect(rdb) as con:
+                    self.assertEqual(con.execute("SELECT batches FROM Checkpoint;").fetchall(), [(7,)])
+
+    def test_15_formats(self):
+        p = 'streamlod' + sep + 'data' + sep + 'process.json'
+        rdb = 'streamlod' + sep + 'databases' + sep + 'relational_formats.db'
+        with open(p) as file:
+            records = json.load(file)
+
+        puh = ProcessDataUploadHandler()
+        q = ProcessDataQueryHandler()
+        q.setDbPathOrUrl(rdb)
+        puh.setDbPathOrUrl(rdb, reset=True)
+        puh.pushDataToDb(p)
+        expected = q.getAllActivities().fillna('').to_dict('records')
+
+        with TemporaryDirectory() as directory:
+            paths = {name: directory + sep + name for name in ('process.json.gz', 'process.jsonl.gz')}
+            with gzip.open(paths['process.json.gz'], 'wt', encoding='utf-8') as file:
+                json.dump(records, file)
+            with gzip.open(paths['process.jsonl.gz'], 'wt', encoding='utf-8') as file:
+                file.writelines(json.dumps(record) + '\n' for record in records)
+            if pq is not None: # One struct column per activity, and a column to leave out
+                paths['process.parquet'] = directory + sep + 'process.parquet'
+                table = pa.Table.from_pylist([dict(record, notes='Not an activity') for record in records])
+                pq.write_table(table, paths['process.parquet'], row_group_size=10)
+
+            for path in paths.values():
+                puh.setDbPathOrUrl(rdb, reset=True)
+                self.assertTrue(puh.pushDataToDb(path))
+                self.assertEqual(q.getAllActivities().fillna('').to_dict('records'), expected)
+
+            if pq is None:
+                return
+            # Only the object id and the activities are read from Parquet, in row batches
+            chunks = list(puh._read(paths['process.parquet'], 10))
+            self.assertEqual(len(chunks), -(-len(records) // 10))
+            self.assertFalse(any(column.startswith('notes') for column in chunks[0].columns))
+
+            with mock.patch('streamlod.handlers.process.pq', None):
+                self.assertFalse(puh.pushDataToDb(paths['process.parquet']))
+
+
+class Test_03_Entities(unittest.TestCase):
+    def test_01_entities(self):
+        def build(suffix=''):
+            person = Person('VIAF:1', 'Anna')
+            obj = Painting('1', 'Title', 'Owner' + suffix, 'Place', None, [person])
+            return person, obj, Acquisition(obj, 'Photogrammetry', 'Institute', tool={'Nikon'})
+
+        first, second = build(), build()
+        for x, y in zip(first, second):
+            self.assertFalse(hasattr(x, '__dict__'))
+            self.assertEqual(hash(x), hash(x))
+            self.assertEqual((x, hash(x)), (y, hash(y)))
+        self.assertNotEqual(first[2], build('s')[2])
+        self.assertEqual(len(set(first + second)), 3)
+
+        # Collections returned by the getters are copies, hashes stay valid
+        person, obj, acquisition = first
+        obj.getAuthors().append(Person('VIAF:2', 'Bob'))
+        acquisition.getTools().add('Canon')
+        self.assertEqual((obj, acquisition), second[1:])
+        self.assertIn(acquisition, set(second))
+        self.assertIsInstance(acquisition.getTools(), set)
+
+        # Repeated values are shared, even when built separately
+        self.assertIs(Painting('2', 'T', ''.join(['Own', 'er']), 'P').owner, first[1].owner)
+
+
+class Test_04_SortKey(unittest.TestCase):
+    def test_01_sort_key(self):
+        ids = ['10', '2', '02', 'b', 'a10', 'a2', '0', '', '9223372036854775807', '2', 'B', '٣']
+        for values in (ids, ids + ['123456789012345678901']): # Beyond 64 bits
+            s = pd.Series(values, name='identifier')
+            self.assertEqual(s.sort_values(key=sorter, kind='stable').tolist(), sorted(values, key=key))
+            self.assertEqual(pd.Index(values, name='refersTo').sort_values(key=sorter).tolist(), sorted(values, key=key))
+
+        # Ties are kept for the next sort column
+        df = pd.DataFrame({'identifier': ['2', '10', '02', '2', 'a'], 'p_name': ['B', 'A', 'A', 'A', 'A']})
+        result = df.sort_values(by=['identifier', 'p_name'], key=sorter, kind='stable')
+        self.assertEqual(list(zip(result.identifier, result.p_name)), [('02', 'A'), ('2', 'A'), ('2', 'B'), ('10', 'A'), ('a', 'A')])
+
+        # Stored ranks, with ties compared as strings, agree with key beyond 64 bits too
+        ids = ['9999999999999999999', '10000000000000000000', '999999999999999999', '123456789012345678901', 'a', '7']
+        self.assertEqual(sorted(ids, key=lambda x: (id_rank(x), x)), sorted(ids, key=key))
+
+
+class Test_05_Emitters(unittest.TestCase):
+    def test_01_emitters(self):
+        handler = MetadataUploadHandler()
+        paths = ['streamlod' + sep + 'data' + sep + name for name in ('meta.csv', 'conflicting' + sep + 'meta1.csv', 'incomplete' + sep + 'meta1.csv')]
+        for df in [handler._read(path) for path in paths] + [metadata(500)]:
+            triples, interpreted = list(handler.toRDF(df.copy())), list(interpreted_toRDF(handler, df.copy()))
+            self.assertEqual(set(triples), set(interpreted))
+            self.assertLessEqual(len(triples), len(interpreted))
+
+        # Authors already converted in a previous batch of the push are only linked
+        handler._reset() # New push
+        df = metadata(40)
+        first, second = handler._triples(df.iloc[:20].copy()), handler._triples(df.iloc[20:].copy())
+        people = {triple.split()[0] for triple in first + second if 'edm:Agent' in triple}
+        self.assertEqual(len(people), len({triple.split()[-2] for triple in first + second if 'dc:creator' in triple}))
+        self.assertGreater(handler.deduplicated, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,21 @@
-from typing import Union, List
+from typing import Union, List, Dict, Optional, TextIO, Iterable, Callable, Hashable, Any
+from datetime import date as Date
+from calendar import monthrange
+from concurrent.futures import Future
+from threading import Lock
+from collections import OrderedDict
+from time import monotonic, sleep
+from functools import wraps
+from sys import intern
+import asyncio
+import re
+import gzip
+import math
+from hashlib import blake2b
+from urllib.parse import quote_plus
+from urllib.error import URLError, HTTPError
+import sqlite3
+import numpy as np
 import pandas as pd
 
 def id_join(identifiers: Union[str, int, List[str]], join_char: str = ' ') -> str:
@@ -10,6 +27,49 @@ def id_join(identifiers: Union[str, int, List[str]], join_char: str = ' ') -> st
     else:
         return join_char.join(f'"{identifier}"' for identifier in identifiers)
 
+def stable_hash(content: str) -> int:
+    """
+    Provides a 64-bit signed hash of a string, stable across processes and storable as SQLite integer.
+    """
+    return int.from_bytes(blake2b(content.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+def quote_all(values: pd.Series) -> pd.Series:
+    """
+    Applies quote_plus to a column of strings: values of unreserved characters only are kept as they are,
+    the others are quoted once per distinct value.
+    """
+    unsafe = ~values.str.fullmatch(r'[A-Za-z0-9_.~-]*').eq(True).to_numpy()
+    if not unsafe.any():
+        return values
+    codes, uniques = pd.factorize(values[unsafe])
+    quoted = values.copy()
+    quoted[unsafe] = np.array([quote_plus(value) for value in uniques], dtype=object)[codes]
+    return quoted
+
+def file_format(path: str) -> str:
+    """
+    Returns the lowercase extension of a file path, ignoring a final .gz compression suffix.
+    """
+    path = path.lower()
+    if path.endswith('.gz'):
+        path = path[:-3]
+    return path.rsplit('.', 1)[-1] if '.' in path else ''
+
+def open_text(path: str) -> TextIO:
+    """
+    Opens a text file for reading, decompressing it on the fly if gzipped.
+    """
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    else:
+        return open(path, 'r', encoding='utf-8')
+
+def interned(value: Any) -> Any:
+    """
+    Returns the shared copy of a string, so that a value repeated across entities is stored once.
+    """
+    return intern(value) if type(value) is str else value
+
 def key(val: str) -> tuple[int, Union[int, str]]:
     """
     Provides a custom sorting key for alphanumeric string identifiers.
@@ -28,6 +88,25 @@ def key(val: str) -> tuple[int, Union[int, str]]:
     else:
         return val
 
+MAX_RANK = 2 ** 63 - 1 # Largest integer storable in SQLite
+LONG_RANK = 10 ** 18 # Above every numeric value of at most 18 digits
+
+def id_rank(val: str) -> int:
+    """
+    Provides an integer counterpart of key, precomputed at ingest and stored in the databases.
+    Numeric values are ranked by their integer value. Longer numeric values, beyond 64 bits,
+    are ranked after them by their number of significant digits and are then compared as strings
+    by the database itself, which is their integer order unless they have leading zeros.
+    Non-numeric values all share the maximum rank, so that they follow the numeric ones
+    and are then compared as strings as well.
+    """
+    if not val.isdigit():
+        return MAX_RANK
+    elif len(val) < 19:
+        return int(val)
+    else:
+        return LONG_RANK + len(val.lstrip('0'))
+
 rank = {
     'Acquisition': 1,
     'Processing': 2,
@@ -36,10 +115,305 @@ rank = {
     'Exporting': 5
 }
 
+def key_rank(s: pd.Index | pd.Series) -> Union[np.ndarray, pd.Series]:
+    """
+    Vectorized counterpart of key: returns the dense rank of each value in the order given by key,
+    numeric values first by integer value, then the others as strings. Missing values get NaN.
+    Numeric values beyond 64 bits fall back to key.
+    """
+    text = pd.Series(s, dtype=object, copy=False).reset_index(drop=True)
+    if text.empty:
+        return np.empty(0)
+    defined = text.notna().to_numpy()
+    numeric = text.str.isdigit().eq(True).to_numpy()
+
+    numbers = np.zeros(len(text), dtype=np.int64)
+    if numeric.any():
+        try:
+            numbers[numeric] = text[numeric].to_numpy().astype(np.int64)
+        except OverflowError:
+            return text.map(key)
+    words = ~numeric & defined
+    codes = np.zeros(len(text), dtype=np.int64)
+    codes[words] = pd.factorize(text[words], sort=True)[0]
+    group = np.where(numeric, 0, np.where(defined, 1, 2))
+
+    # Two-level sort: group first, then number or string code
+    order = np.lexsort((codes, numbers, group))
+    change = (np.diff(group[order]) != 0) | (np.diff(numbers[order]) != 0) | (np.diff(codes[order]) != 0)
+    ranks = np.empty(len(text))
+    ranks[order] = np.concatenate(([0], np.cumsum(change)))
+    ranks[~defined] = np.nan
+    return ranks
+
 def sorter(s: pd.Index | pd.Series) -> pd.Index | pd.Series:
     if s.name == 'refersTo' or s.name == 'identifier':
-        return s.map(key)
+        ranks = key_rank(s)
+        if isinstance(ranks, pd.Series): # Fallback
+            ranks = ranks.to_numpy()
+        return pd.Index(ranks, name=s.name) if isinstance(s, pd.Index) else pd.Series(ranks, index=s.index, name=s.name)
     elif s.name == 'class':
         return s.map(rank)
     else:
         return s
+
+
+_date_pattern = re.compile(r'^\s*(?P<year>\d{1,4})(?:-(?P<month>\d{1,2})(?:-(?P<day>\d{1,2}))?)?(?:T.*)?\s*$')
+_years_pattern = re.compile(r'^\s*(?P<first>\d{3,4})\s*-\s*(?P<last>\d{3,4})\s*$')
+
+def day_interval(date: str) -> tuple[Optional[int], Optional[int]]:
+    """
+    Converts a possibly partial date into the interval of days it covers,
+    as a tuple of proleptic Gregorian ordinals (first day, last day).
+    Accepts full dates (2023-05-08), months (2023-05), years (2023)
+    and metadata-style year ranges (1500-1599).
+    Returns (None, None) if the string is not a recognizable date.
+    """
+    try:
+        if (match := _years_pattern.match(date)):
+            first, last = int(match['first']), int(match['last'])
+            return Date(first, 1, 1).toordinal(), Date(last, 12, 31).toordinal()
+
+        elif (match := _date_pattern.match(date)):
+            year = int(match['year'])
+            if match['day']:
+                day = Date(year, int(match['month']), int(match['day'])).toordinal()
+                return day, day
+            elif match['month']:
+                month = int(match['month'])
+                return Date(year, month, 1).toordinal(), Date(year, month, monthrange(year, month)[1]).toordinal()
+            else:
+                return Date(year, 1, 1).toordinal(), Date(year, 12, 31).toordinal()
+
+    except (TypeError, ValueError): # Not a string or out of range values
+        pass
+
+    return None, None
+
+def day_condition(attribute: str, date: str, after: bool = True) -> str:
+    """
+    Builds an SQL condition on the indexed day column of a date attribute.
+    Dates after the given one are compared with its first day, dates before with its last day.
+    If the date is not recognizable, falls back to the string comparison on the original attribute.
+    """
+    first, last = day_interval(date)
+    if first is None:
+        return f"{attribute} {'>=' if after else '<='} '{date}'"
+    elif after:
+        return f"{attribute}Day >= {first}"
+    else:
+        return f"{attribute}Day <= {last}"
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set of identifiers, used to route lookups to the databases that can hold them.
+    Membership tests never give false negatives, and give false positives at about error_rate
+    as long as no more than capacity identifiers are added.
+    """
+    def __init__(self, identifiers: Iterable[str] = (), capacity: int = 100000, error_rate: float = 0.01):
+        self.errorRate = error_rate
+        self.rebuild(identifiers, capacity)
+
+    def rebuild(self, identifiers: Iterable[str], capacity: int) -> None:
+        """
+        Empties the filter in place, sizes it for capacity identifiers and adds the given ones,
+        so that the routes holding the filter see the new content.
+        """
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(self.errorRate) / math.log(2) ** 2)) # Bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0 # Identifiers added, repeated ones included
+        self.update(identifiers)
+
+    def _positions(self, identifier: str) -> Iterable[int]:
+        # Double hashing: k positions from the two halves of a single digest
+        digest = blake2b(str(identifier).encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, identifier: str) -> None:
+        for position in self._positions(identifier):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, identifiers: Iterable[str]) -> None:
+        for identifier in identifiers:
+            self.add(identifier)
+
+    def clear(self) -> None:
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+    def __contains__(self, identifier: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(identifier))
+
+
+class HashRoute:
+    """
+    Set of the identifiers assigned to one of count databases by their stable hash,
+    the same partitioning used for sharded process databases.
+    """
+    def __init__(self, position: int, count: int):
+        self.position = position
+        self.count = count
+
+    def __contains__(self, identifier: str) -> bool:
+        return stable_hash(str(identifier)) % self.count == self.position
+
+
+class MissCache:
+    """
+    Bounded set of recently missed lookups, forgotten after ttl seconds,
+    so that repeated lookups of absent identifiers do not reach the databases again.
+    When full, the oldest misses are dropped first.
+    """
+    def __init__(self, size: int = 10000, ttl: float = 30.0):
+        self.size = size
+        self.ttl = ttl
+        self._misses: OrderedDict[str, float] = OrderedDict() # Identifier: expiry
+        self._lock = Lock()
+        self.hits = 0 # Lookups answered as misses without querying
+
+    def add(self, identifier: str) -> None:
+        if not self.size:
+            return
+        with self._lock:
+            self._misses[identifier] = monotonic() + self.ttl
+            self._misses.move_to_end(identifier)
+            while len(self._misses) > self.size:
+                self._misses.popitem(last=False)
+
+    def discard(self, identifiers: Iterable[str]) -> None:
+        with self._lock:
+            for identifier in identifiers:
+                self._misses.pop(identifier, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._misses.clear()
+
+    def __contains__(self, identifier: str) -> bool:
+        with self._lock:
+            expiry = self._misses.get(identifier)
+            if expiry is None:
+                return False
+            if expiry <= monotonic():
+                del self._misses[identifier]
+                return False
+            self.hits += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self._misses)
+
+def flight_key(name: str, args: tuple, kwargs: Dict[str, Any]) -> Hashable:
+    """
+    Normalizes a query call into a hashable key: collections of identifiers are compared as sorted sets,
+    tuples such as relations keep their order.
+    """
+    def normalize(value: Any) -> Hashable:
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return value
+        elif isinstance(value, tuple):
+            return tuple(normalize(item) for item in value)
+        elif isinstance(value, (list, set, frozenset, np.ndarray, pd.Series, pd.Index)):
+            return tuple(sorted({str(item) for item in value}))
+        else:
+            return repr(value)
+
+    return name, normalize(args), tuple(sorted((key, normalize(value)) for key, value in kwargs.items()))
+
+def shared(result: Any) -> Any:
+    """
+    Returns the result of a coalesced call for another caller: mutable containers are copied,
+    so that callers can modify them, while the entities they hold, and any other result, are shared as they are.
+    """
+    if isinstance(result, (pd.DataFrame, pd.Series, np.ndarray, list, dict, set)):
+        return result.copy()
+    return result
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first one runs, the others wait for it
+    and get a shared copy of its result, or its exception. Works across threads and asyncio tasks.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self.coalesced = 0 # Calls served by another in-flight call
+
+    def do(self, key: Hashable, function: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            return shared(future.result())
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def doAsync(self, key: Hashable, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        As do, for coroutines: a blocking call runs in a worker thread and waiting tasks do not hold any.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+        if future is not None:
+            return shared(await asyncio.wrap_future(future))
+        return await asyncio.to_thread(self.do, key, function, *args, **kwargs)
+
+def coalesced(method: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Makes concurrent calls of a query method with the same arguments on the same instance
+    share one execution, through the SingleFlight in its flight attribute.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.flight.do(flight_key(method.__name__, args, kwargs), method, self, *args, **kwargs)
+    return wrapper
+
+def transient(e: BaseException) -> bool:
+    """
+    Tells whether a failure is worth retrying: unreachable endpoints, timeouts, server-side HTTP errors
+    and busy or locked SQLite databases.
+    """
+    if isinstance(e, HTTPError):
+        return e.code >= 500 or e.code == 429
+    if isinstance(e, (URLError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(e, sqlite3.OperationalError):
+        message = str(e).lower()
+        return 'locked' in message or 'busy' in message or 'disk i/o' in message
+    return False
+
+def retry(function: Callable[[], Any], attempts: int = 5, delay: float = 0.5) -> Any:
+    """
+    Calls function until it succeeds, at most attempts times. After a transient failure the call is repeated
+    after delay seconds, doubled at every further failure. Other failures, and the last one, are raised.
+    """
+    for attempt in range(attempts):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == attempts - 1 or not transient(e):
+                raise
+            sleep(delay * 2 ** attempt)